@@ -1,17 +1,26 @@
 from __future__ import annotations
 
-from fastapi import APIRouter, HTTPException
+import orjson
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Request
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel
 
 from core.models import BlockRef
 from core.agent import GitHistoryAgent
 from core.git_core import GitError
 
-# Router for all chat-related endpoints
-router = APIRouter()
+# Router for all chat-related endpoints; responses are encoded with orjson
+router = APIRouter(default_response_class=ORJSONResponse)
 
-# Single shared agent instance for handling questions
-agent = GitHistoryAgent()
+
+def get_agent(request: Request) -> GitHistoryAgent:
+    """
+    Dependency returning the agent created in the app lifespan.
+
+    All agents share one pooled OpenAI client, so this is cheap to inject
+    per request and easy to override in tests.
+    """
+    return request.app.state.agent
 
 
 class ChatRequest(BaseModel):
@@ -24,7 +33,10 @@ class ChatResponse(BaseModel):
 
 
 @router.post("/chat", response_model=ChatResponse)
-async def chat(req: ChatRequest) -> ChatResponse:
+async def chat(
+    req: ChatRequest,
+    agent: GitHistoryAgent = Depends(get_agent),
+) -> ChatResponse:
     """
     Main chat endpoint.
 
@@ -36,7 +48,7 @@ async def chat(req: ChatRequest) -> ChatResponse:
     (code context, history context, etc.) and return a final answer.
     """
     try:
-        answer = agent.answer_question(
+        answer = await agent.answer_question(
             block_ref=req.block_ref,
             question=req.question,
         )
@@ -47,4 +59,61 @@ async def chat(req: ChatRequest) -> ChatResponse:
         # Catch-all for unexpected failures
         raise HTTPException(status_code=500, detail="Internal server error")
 
-    return ChatResponse(answer=answer)
\ No newline at end of file
+    return ChatResponse(answer=answer)
+
+
+class WarmupRequest(BaseModel):
+    block_ref: BlockRef
+
+
+@router.post("/chat/warmup", status_code=202)
+async def chat_warmup(
+    req: WarmupRequest,
+    background_tasks: BackgroundTasks,
+    agent: GitHistoryAgent = Depends(get_agent),
+) -> None:
+    """
+    Prefetch code and history context for a block the user just opened.
+
+    Returns immediately; the git work runs in the background so the first
+    /chat question about the block finds it cached.
+    """
+    background_tasks.add_task(agent.warmup, req.block_ref)
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
+
+@router.post("/chat/stream")
+async def chat_stream(
+    req: ChatRequest,
+    agent: GitHistoryAgent = Depends(get_agent),
+) -> StreamingResponse:
+    """
+    Streaming variant of /chat.
+
+    The answer is sent as server-sent events while it is generated:
+      - `token` events carry `{"token": "..."}` chunks of the answer
+      - a final `done` event, or an `error` event with `{"detail": "..."}`
+
+    Errors can only be reported in-stream because the 200 response has
+    already started by the time tools run.
+    """
+
+    async def events():
+        try:
+            async for token in agent.answer_question_stream(
+                block_ref=req.block_ref,
+                question=req.question,
+            ):
+                yield _sse("token", {"token": token})
+        except GitError as e:
+            yield _sse("error", {"detail": f"Git error: {e}"})
+            return
+        except Exception:
+            yield _sse("error", {"detail": "Internal server error"})
+            return
+        yield _sse("done", {})
+
+    return StreamingResponse(events(), media_type="text/event-stream")
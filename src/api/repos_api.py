@@ -1,14 +1,23 @@
 from __future__ import annotations
 
+import asyncio
+import base64
+import hashlib
+import threading
+import time
+import zlib
+from collections import OrderedDict
 from datetime import datetime, timezone
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Set, Tuple, Type, TypeVar
 
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, BackgroundTasks, Depends, HTTPException, Query, Request, Response
+from postgrest.types import ReturnMethod
 from pydantic import BaseModel
+from supabase import AsyncClient
 
 from graph.graph_models import Repo, RepoGraph, RepoStatus, TreeNode
 from graph.ingestion import ingest_repo
-from supabase_client import supabase
+from supabase_client import get_supabase_client
 import logging
 import json
 
@@ -24,15 +33,54 @@ from config import settings
 
 DEMO_ORG_ID = settings.demo_org_id
 
+# In-process LRU of parsed tree/graph snapshots and repo listings. Snapshots
+# only change on re-ingestion, which invalidates them explicitly; the TTL
+# bounds staleness across worker processes.
+_READ_CACHE_MAXSIZE = 256
+_READ_CACHE_TTL = 300.0
+_READ_CACHE: "OrderedDict[Tuple[str, str], Tuple[float, Any]]" = OrderedDict()
+_READ_CACHE_LOCK = threading.Lock()
+# Listings include the ingestion status clients poll on, so keep them fresh.
+_LIST_CACHE_TTL = 5.0
+
+
+def _cache_get(key: Tuple[str, str]) -> Any | None:
+    with _READ_CACHE_LOCK:
+        cached = _READ_CACHE.get(key)
+        if cached is None:
+            return None
+        expires_at, value = cached
+        if expires_at <= time.monotonic():
+            del _READ_CACHE[key]
+            return None
+        _READ_CACHE.move_to_end(key)
+        return value
+
+
+def _cache_put(key: Tuple[str, str], value: Any, ttl: float = _READ_CACHE_TTL) -> None:
+    with _READ_CACHE_LOCK:
+        _READ_CACHE[key] = (time.monotonic() + ttl, value)
+        _READ_CACHE.move_to_end(key)
+        if len(_READ_CACHE) > _READ_CACHE_MAXSIZE:
+            _READ_CACHE.popitem(last=False)
+
+
+def _invalidate_repo(repo_id: str) -> None:
+    with _READ_CACHE_LOCK:
+        _READ_CACHE.pop(("tree", repo_id), None)
+        _READ_CACHE.pop(("graph", repo_id), None)
+        for key in [key for key in _READ_CACHE if key[0] == "repos"]:
+            del _READ_CACHE[key]
+
 
 # ---------------------------------------------------------------------------
 # Debug endpoint: basic Supabase connectivity check
 # ---------------------------------------------------------------------------
 
 @router.get("/debug/supabase")
-async def debug_supabase():
+async def debug_supabase(supabase: AsyncClient = Depends(get_supabase_client)):
     try:
-        res = supabase.table("repos").select("id").limit(1).execute()
+        res = await supabase.table("repos").select("id").limit(1).execute()
         return {"status": "ok", "data": res.data}
     except Exception as e:
         return {"status": "error", "error": str(e)}
@@ -59,8 +107,43 @@ class RepoResponse(BaseModel):
     last_error: Optional[str] = None
 
 
+# (org_id, owner, name) of repos this process has seen. Onboarding a repo not
+# in here goes straight to an insert-or-ignore instead of a lookup first; this
+# relies on a unique constraint:
+#   ALTER TABLE repos ADD CONSTRAINT repos_org_owner_name_key UNIQUE (org_id, owner, name);
+_KNOWN_REPOS: Set[Tuple[str, str, str]] = set()
+
+
+# Columns the handlers read from `repos`; never select("*").
+_REPO_COLUMNS = "id,owner,name,github_url,default_branch,status,last_error,created_at,updated_at"
+# `list_repos` needs the RepoResponse fields plus the pagination key. `last_error`
+# can be large and is left to `get_repo`.
+_REPO_LIST_COLUMNS = "id,owner,name,github_url,default_branch,status,created_at"
+
+
+# Rows come from our own writes, so models are built with `model_construct`
+# and skip validation; only request bodies are validated.
+
+def _row_timestamp(row: dict, key: str, default: datetime) -> datetime:
+    value = row.get(key)
+    return datetime.fromisoformat(value) if value else default
+
+
+def _ingest_in_progress(row: dict) -> bool:
+    # Ingestion runs as a background task in one worker; if that worker dies
+    # the row stays 'cloning', so only a recently touched row counts.
+    if row.get("status") != RepoStatus.cloning.value or not row.get("updated_at"):
+        return False
+    updated_at = datetime.fromisoformat(row["updated_at"])
+    if updated_at.tzinfo is None:
+        updated_at = updated_at.replace(tzinfo=timezone.utc)
+    age = (datetime.now(timezone.utc) - updated_at).total_seconds()
+    return age < settings.ingest_timeout_seconds
+
+
 def _row_to_repo(row: dict) -> Repo:
-    return Repo(
+    now = datetime.now(timezone.utc)
+    return Repo.model_construct(
         id=str(row["id"]),
         owner=row["owner"],
         name=row["name"],
@@ -68,21 +151,20 @@ def _row_to_repo(row: dict) -> Repo:
         default_branch=row.get("default_branch") or "main",
         status=RepoStatus(row.get("status", RepoStatus.pending.value)),
         last_error=row.get("last_error"),
-        created_at=row.get("created_at") or datetime.now(timezone.utc),
-        updated_at=row.get("updated_at") or datetime.now(timezone.utc),
+        created_at=_row_timestamp(row, "created_at", now),
+        updated_at=_row_timestamp(row, "updated_at", now),
     )
 
 
 def _row_to_repo_response(row: dict) -> RepoResponse:
-    repo = _row_to_repo(row)
-    return RepoResponse(
-        id=repo.id,
-        owner=repo.owner,
-        name=repo.name,
-        github_url=repo.github_url,
-        default_branch=repo.default_branch,
-        status=repo.status,
-        last_error=repo.last_error,
+    return RepoResponse.model_construct(
+        id=str(row["id"]),
+        owner=row["owner"],
+        name=row["name"],
+        github_url=row["github_url"],
+        default_branch=row.get("default_branch") or "main",
+        status=RepoStatus(row.get("status", RepoStatus.pending.value)),
+        last_error=row.get("last_error"),
     )
 
 
@@ -90,140 +172,295 @@ def _row_to_repo_response(row: dict) -> RepoResponse:
 # Endpoints
 # ---------------------------------------------------------------------------
 
-@router.post("/repos", response_model=RepoResponse)
-async def onboard_repo(body: OnboardRepoRequest) -> RepoResponse:
+async def _upsert_snapshot(
+    supabase: AsyncClient,
+    table: str,
+    repo_id: str,
+    columns: Dict[str, Any],
+    generated_at: str,
+) -> None:
     """
-    Onboard a new repository by cloning it and building its graph.
+    Replace a repo's tree/graph snapshot row in a single round-trip.
 
-    Phase 0:
-      - All repos are associated with a single demo org (DEMO_ORG_ID).
-      - Ingestion is synchronous and blocking.
-      - Tree and graph are stored in Supabase as JSON blobs.
-    """
-    owner = body.owner.strip()
-    name = body.name.strip()
-    github_url = body.github_url.strip()
-    default_branch = body.default_branch or "main"
+    PostgREST is asked not to echo the (possibly multi-MB) row back.
 
-    logger.info(f"Onboarding repo: owner={owner}, name={name}, url={github_url}")
-
-    # 1) Check if repo already exists for this org + owner + name
-    logger.info("Checking if repo already exists in Supabase...")
-    existing = supabase.table("repos") \
-        .select("*") \
-        .eq("org_id", DEMO_ORG_ID) \
-        .eq("owner", owner) \
-        .eq("name", name) \
-        .limit(1) \
-        .execute()
+    Requires a unique constraint on `repo_id`:
+      ALTER TABLE repo_trees ADD CONSTRAINT repo_trees_repo_id_key UNIQUE (repo_id);
+      ALTER TABLE repo_graphs ADD CONSTRAINT repo_graphs_repo_id_key UNIQUE (repo_id);
+    """
+    row = {
+        "repo_id": repo_id,
+        **columns,
+        "generated_at": generated_at,
+    }
+    await supabase.table(table).upsert(
+        row, on_conflict="repo_id", returning=ReturnMethod.minimal
+    ).execute()
+
+
+# Snapshots are stored as base64 text of zlib-compressed JSON in `tree_blob` /
+# `graph_blob`, which shrinks the stored row and every read several times over:
+#   ALTER TABLE repo_trees ADD COLUMN tree_blob text;
+#   ALTER TABLE repo_graphs ADD COLUMN graph_blob text;
+# Rows written before that still only have `tree_json` / `graph_json`.
+# `tree_etag` / `graph_etag` (text) hold a hash of the JSON for conditional GETs.
+_SNAPSHOT_COMPRESSION_LEVEL = 6
+
+_SnapshotModel = TypeVar("_SnapshotModel", TreeNode, RepoGraph)
+
+
+def _snapshot_columns(kind: str, payload_json: str) -> Dict[str, Any]:
+    payload = payload_json.encode()
+    compressed = zlib.compress(payload, _SNAPSHOT_COMPRESSION_LEVEL)
+    return {
+        f"{kind}_blob": base64.b64encode(compressed).decode("ascii"),
+        f"{kind}_etag": hashlib.blake2b(payload, digest_size=16).hexdigest(),
+        # Legacy column, cleared as rows are rewritten.
+        f"{kind}_json": None,
+    }
+
+
+def _decode_snapshot(model: Type[_SnapshotModel], row: dict, kind: str) -> _SnapshotModel:
+    blob = row.get(f"{kind}_blob")
+    if blob is None:
+        return model.model_validate(row[f"{kind}_json"])
+    return model.model_validate_json(zlib.decompress(base64.b64decode(blob)))
+
+
+def _ingest_to_columns(repo: Repo) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    tree, graph = ingest_repo(repo)
+    return (
+        _snapshot_columns("tree", tree.model_dump_json()),
+        _snapshot_columns("graph", graph.model_dump_json()),
+    )
 
-    repo_row: Optional[dict] = None
-    if existing.data:
-        repo_row = existing.data[0]
-    else:
-        # 2) Insert new repo row with status 'pending' / 'cloning'
-        insert_res = supabase.table("repos").insert({
-            "owner": owner,
-            "name": name,
-            "github_url": github_url,
-            "default_branch": default_branch,
-            "status": "cloning",
-            "org_id": DEMO_ORG_ID,
-        }).execute()
-
-        if not insert_res.data:
-            raise HTTPException(
-                status_code=500,
-                detail="Failed to create repo record in Supabase.",
-            )
-        repo_row = insert_res.data[0]
-        logger.info(f"Inserted new repo row with id={repo_row['id']}")
 
-    # Build a Repo model from the row so ingest_repo can use it
-    repo = _row_to_repo(repo_row)
+async def _run_ingestion(supabase: AsyncClient, repo: Repo) -> None:
+    """
+    Clone, parse and graph a repo, then store the results and final status.
 
+    Runs as a background task after `onboard_repo` has responded. The
+    clone/parse work and snapshot encoding run in a worker thread, so they
+    never block the event loop.
+    """
     try:
         logger.info(f"Starting ingestion for repo id={repo.id}")
+        # Marks the run as live for `_ingest_in_progress`.
+        await supabase.table("repos").update({
+            "updated_at": datetime.now(timezone.utc).isoformat(),
+        }).eq("id", repo.id).execute()
         # 3) Run ingestion pipeline (clone + parse + graph)
-        tree, graph = ingest_repo(repo)
+        tree_columns, graph_columns = await asyncio.to_thread(_ingest_to_columns, repo)
 
         logger.info(f"Ingestion complete for repo id={repo.id}")
-
-        # 4) Store tree and graph JSON in Supabase.
-        #    Simple approach: delete any existing rows for this repo_id, then insert.
-        logger.info("Storing tree and graph JSON in Supabase...")
-        supabase.table("repo_trees").delete().eq("repo_id", repo.id).execute()
-        supabase.table("repo_trees").insert({
-            "repo_id": repo.id,
-            "tree_json": tree.model_dump(mode="json"),
-            "generated_at": datetime.now(timezone.utc).isoformat(),
-        }).execute()
-
-        supabase.table("repo_graphs").delete().eq("repo_id", repo.id).execute()
-        supabase.table("repo_graphs").insert({
-            "repo_id": repo.id,
-            "graph_json": graph.model_dump(mode="json"),
-            "generated_at": datetime.now(timezone.utc).isoformat(),
-        }).execute()
-
-        # 5) Update repo status to 'ready'
-        update_res = supabase.table("repos").update({
+        now_iso = datetime.now(timezone.utc).isoformat()
+
+        # 4) Store tree and graph snapshots concurrently (one round-trip of
+        #    wall time). Both must have landed before the repo is marked
+        #    'ready', so readers never see 'ready' without its snapshots.
+        logger.info("Storing tree and graph snapshots in Supabase...")
+        results = await asyncio.gather(
+            _upsert_snapshot(supabase, "repo_trees", repo.id, tree_columns, now_iso),
+            _upsert_snapshot(supabase, "repo_graphs", repo.id, graph_columns, now_iso),
+            return_exceptions=True,
+        )
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+        # 5) Mark repo as 'ready'
+        await supabase.table("repos").update({
             "status": "ready",
             "last_error": None,
-            "last_ingested_at": datetime.now(timezone.utc).isoformat(),
-            "updated_at": datetime.now(timezone.utc).isoformat(),
+            "last_ingested_at": now_iso,
+            "updated_at": now_iso,
         }).eq("id", repo.id).execute()
 
-        if update_res.data:
-            repo_row = update_res.data[0]
-        else:
-            # If update didn't return data, keep old row but status is logically 'ready'
-            repo_row["status"] = "ready"
-            repo_row["last_error"] = None
-
+        _invalidate_repo(repo.id)
         logger.info(f"Repo {repo.id} marked as ready.")
 
     except Exception as e:
         # On any error, mark repo as 'error' and store the message
         error_message = str(e)
         logger.error(f"Ingestion failed for repo {repo.id}: {error_message}")
-        supabase.table("repos").update({
+        await supabase.table("repos").update({
             "status": "error",
             "last_error": error_message,
             "updated_at": datetime.now(timezone.utc).isoformat(),
         }).eq("id", repo.id).execute()
+        _invalidate_repo(repo.id)
+
+
+@router.post("/repos", response_model=RepoResponse, status_code=202)
+async def onboard_repo(
+    body: OnboardRepoRequest,
+    background_tasks: BackgroundTasks,
+    supabase: AsyncClient = Depends(get_supabase_client),
+) -> RepoResponse:
+    """
+    Onboard a new repository by cloning it and building its graph.
+
+    Responds with 202 as soon as the repo row is in the 'cloning' state;
+    ingestion continues in the background. Clients poll `GET /repos/{id}`
+    until `status` becomes 'ready' (tree and graph available) or 'error'
+    (see `last_error`).
+
+    Phase 0:
+      - All repos are associated with a single demo org (DEMO_ORG_ID).
+      - Tree and graph are stored in Supabase as JSON blobs.
+    """
+    owner = body.owner.strip()
+    name = body.name.strip()
+    github_url = body.github_url.strip()
+    default_branch = body.default_branch or "main"
 
-        repo_row["status"] = "error"
-        repo_row["last_error"] = error_message
+    logger.info(f"Onboarding repo: owner={owner}, name={name}, url={github_url}")
+
+    new_row = {
+        "owner": owner,
+        "name": name,
+        "github_url": github_url,
+        "default_branch": default_branch,
+        "status": "cloning",
+        "org_id": DEMO_ORG_ID,
+    }
+    repo_key = (DEMO_ORG_ID, owner, name)
+
+    repo_row: Optional[dict] = None
+    if repo_key not in _KNOWN_REPOS:
+        # 1) Most onboardings are for new repos, so skip the existence check and
+        #    insert directly. If the row already exists (e.g. created by another
+        #    worker) the insert is ignored, nothing comes back, and we fall
+        #    through to the full check below.
+        insert_res = await supabase.table("repos") \
+            .upsert(new_row, on_conflict="org_id,owner,name", ignore_duplicates=True) \
+            .execute()
+        if insert_res.data:
+            repo_row = insert_res.data[0]
+            logger.info(f"Inserted new repo row with id={repo_row['id']}")
+
+    if repo_row is None:
+        # 1b) Check if repo already exists for this org + owner + name
+        logger.info("Checking if repo already exists in Supabase...")
+        existing = await supabase.table("repos") \
+            .select(_REPO_COLUMNS) \
+            .eq("org_id", DEMO_ORG_ID) \
+            .eq("owner", owner) \
+            .eq("name", name) \
+            .limit(1) \
+            .execute()
+
+        if existing.data:
+            repo_row = existing.data[0]
+            _KNOWN_REPOS.add(repo_key)
+            if _ingest_in_progress(repo_row):
+                # Already being ingested; don't start a second run. A stale
+                # 'cloning' row falls through and is re-ingested.
+                return _row_to_repo_response(repo_row)
+
+            # 2) Re-ingest: move the existing row back to 'cloning' for pollers
+            update_res = await supabase.table("repos").update({
+                "status": "cloning",
+                "last_error": None,
+                "updated_at": datetime.now(timezone.utc).isoformat(),
+            }).eq("id", repo_row["id"]).execute()
+
+            if update_res.data:
+                repo_row = update_res.data[0]
+            else:
+                repo_row["status"] = "cloning"
+                repo_row["last_error"] = None
+        else:
+            # 2) Insert new repo row with status 'pending' / 'cloning'
+            insert_res = await supabase.table("repos").insert(new_row).execute()
+
+            if not insert_res.data:
+                raise HTTPException(
+                    status_code=500,
+                    detail="Failed to create repo record in Supabase.",
+                )
+            repo_row = insert_res.data[0]
+            logger.info(f"Inserted new repo row with id={repo_row['id']}")
+
+    _KNOWN_REPOS.add(repo_key)
+
+    # Build a Repo model from the row so ingest_repo can use it
+    repo = _row_to_repo(repo_row)
+    _invalidate_repo(repo.id)
+    background_tasks.add_task(_run_ingestion, supabase, repo)
 
     return _row_to_repo_response(repo_row)
 
 
+def _encode_cursor(row: dict) -> str:
+    return base64.urlsafe_b64encode(f"{row['created_at']}|{row['id']}".encode()).decode()
+
+
+def _decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        created_at, repo_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|", 1)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
+    return created_at, repo_id
+
+
 @router.get("/repos", response_model=List[RepoResponse])
-async def list_repos() -> List[RepoResponse]:
+async def list_repos(
+    response: Response,
+    limit: int = Query(50, ge=1, le=200),
+    after: Optional[str] = None,
+    supabase: AsyncClient = Depends(get_supabase_client),
+) -> List[RepoResponse]:
     """
-    List all repos for the demo org.
+    List repos for the demo org, newest first, one page at a time.
+
+    Pass the `X-Next-Cursor` response header back as `after` to fetch the
+    next page; the header is absent on the last page. Pages are keyed on
+    `(created_at, id)`, so rows sharing a timestamp are never skipped. `last_error` is not
+    included here; fetch it with `GET /repos/{id}`.
 
     Phase 0: we don't have real auth, so everything is scoped to DEMO_ORG_ID.
     """
-    res = supabase.table("repos") \
-        .select("*") \
-        .eq("org_id", DEMO_ORG_ID) \
-        .order("created_at", desc=True) \
-        .execute()
+    # Only first pages are cached; they are what the UI polls.
+    cache_key = ("repos", f"{DEMO_ORG_ID}:{limit}") if after is None else None
+    cached = _cache_get(cache_key) if cache_key is not None else None
+    if cached is not None:
+        repos, next_cursor = cached
+    else:
+        query = supabase.table("repos") \
+            .select(_REPO_LIST_COLUMNS) \
+            .eq("org_id", DEMO_ORG_ID)
+        if after is not None:
+            created_at, repo_id = _decode_cursor(after)
+            query = query.or_(
+                f'created_at.lt."{created_at}",'
+                f'and(created_at.eq."{created_at}",id.lt."{repo_id}")'
+            )
+        res = await query \
+            .order("created_at", desc=True) \
+            .order("id", desc=True) \
+            .limit(limit) \
+            .execute()
+
+        rows = res.data or []
+        logger.info(f"Listing {len(rows)} repos for org={DEMO_ORG_ID}")
+        repos = [_row_to_repo_response(row) for row in rows]
+        next_cursor = _encode_cursor(rows[-1]) if len(rows) == limit else None
+        if cache_key is not None:
+            _cache_put(cache_key, (repos, next_cursor), ttl=_LIST_CACHE_TTL)
 
-    rows = res.data or []
-    logger.info(f"Listing {len(rows)} repos for org={DEMO_ORG_ID}")
-    return [_row_to_repo_response(row) for row in rows]
+    if next_cursor is not None:
+        response.headers["X-Next-Cursor"] = next_cursor
+    return repos
 
 
 @router.get("/repos/{repo_id}", response_model=RepoResponse)
-async def get_repo(repo_id: str) -> RepoResponse:
+async def get_repo(repo_id: str, supabase: AsyncClient = Depends(get_supabase_client)) -> RepoResponse:
     """
     Fetch a single repo by its id.
     """
-    res = supabase.table("repos") \
-        .select("*") \
+    res = await supabase.table("repos") \
+        .select(_REPO_COLUMNS) \
         .eq("id", repo_id) \
         .eq("org_id", DEMO_ORG_ID) \
         .limit(1) \
@@ -236,44 +473,30 @@ async def get_repo(repo_id: str) -> RepoResponse:
     return _row_to_repo_response(res.data[0])
 
 
-@router.get("/repos/{repo_id}/tree", response_model=TreeNode)
-async def get_repo_tree(repo_id: str) -> TreeNode:
+async def _latest_snapshot(
+    supabase: AsyncClient,
+    table: str,
+    columns: str,
+    repo_id: str,
+):
     """
-    Fetch the most recent tree snapshot for a repo.
-    """
-    # Ensure repo belongs to our demo org
-    repo_res = supabase.table("repos") \
-        .select("id") \
-        .eq("id", repo_id) \
-        .eq("org_id", DEMO_ORG_ID) \
-        .limit(1) \
-        .execute()
-
-    if not repo_res.data:
-        raise HTTPException(status_code=404, detail="Repo not found")
+    Fetch the newest snapshot row for a repo owned by the demo org.
 
-    res = supabase.table("repo_trees") \
-        .select("tree_json") \
+    The ownership check rides along as an inner join on `repos`, so the
+    happy path is a single round-trip.
+    """
+    return await supabase.table(table) \
+        .select(f"{columns}, repos!inner(id)") \
         .eq("repo_id", repo_id) \
+        .eq("repos.org_id", DEMO_ORG_ID) \
         .order("generated_at", desc=True) \
         .limit(1) \
         .execute()
 
-    if not res.data:
-        raise HTTPException(status_code=404, detail="Tree not found for repo")
-
-    tree_json = res.data[0]["tree_json"]
-    logger.info(f"Fetched tree for repo {repo_id}")
-    return TreeNode.model_validate(tree_json)
-
 
-@router.get("/repos/{repo_id}/graph", response_model=RepoGraph)
-async def get_repo_graph(repo_id: str) -> RepoGraph:
-    """
-    Fetch the most recent graph snapshot for a repo.
-    """
-    # Ensure repo belongs to our demo org
-    repo_res = supabase.table("repos") \
+async def _raise_missing_snapshot(supabase: AsyncClient, repo_id: str, detail: str) -> None:
+    # Only on a miss do we pay a second lookup, to tell "no repo" from "no snapshot".
+    repo_res = await supabase.table("repos") \
         .select("id") \
         .eq("id", repo_id) \
         .eq("org_id", DEMO_ORG_ID) \
@@ -282,17 +505,91 @@ async def get_repo_graph(repo_id: str) -> RepoGraph:
 
     if not repo_res.data:
         raise HTTPException(status_code=404, detail="Repo not found")
+    raise HTTPException(status_code=404, detail=detail)
+
+
+def _etag_matches(request: Request, etag: str | None) -> bool:
+    if etag is None:
+        return False
+    if_none_match = request.headers.get("if-none-match")
+    if not if_none_match:
+        return False
+    candidates = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return f'"{etag}"' in candidates or "*" in candidates
+
+
+async def _get_snapshot(
+    request: Request,
+    response: Response,
+    supabase: AsyncClient,
+    repo_id: str,
+    kind: str,
+    model: Type[_SnapshotModel],
+) -> _SnapshotModel | Response:
+    """
+    Serve the latest tree/graph snapshot, honouring `If-None-Match`.
 
-    res = supabase.table("repo_graphs") \
-        .select("graph_json") \
-        .eq("repo_id", repo_id) \
-        .order("generated_at", desc=True) \
-        .limit(1) \
-        .execute()
+    Snapshots are served from the in-process cache when possible. On a miss
+    with a conditional request, only the ETag is fetched first, so an
+    unchanged snapshot never crosses the wire; otherwise one query fetches
+    everything.
+    """
+    table = f"repo_{kind}s"
+    # Snapshots change on re-ingestion, so clients must revalidate every time;
+    # an unchanged snapshot still costs only a 304 thanks to the ETag.
+    headers = {"Cache-Control": "no-cache"}
+    cache_key = (kind, repo_id)
+    cached = _cache_get(cache_key)
+
+    if cached is None and request.headers.get("if-none-match"):
+        res = await _latest_snapshot(supabase, table, f"{kind}_etag", repo_id)
+        if res.data and _etag_matches(request, res.data[0][f"{kind}_etag"]):
+            cached = (res.data[0][f"{kind}_etag"], None)
+
+    if cached is None:
+        res = await _latest_snapshot(
+            supabase, table, f"{kind}_blob, {kind}_json, {kind}_etag", repo_id
+        )
+        if not res.data:
+            await _raise_missing_snapshot(
+                supabase, repo_id, f"{kind.capitalize()} not found for repo"
+            )
 
-    if not res.data:
-        raise HTTPException(status_code=404, detail="Graph not found for repo")
+        logger.info(f"Fetched {kind} for repo {repo_id}")
+        row = res.data[0]
+        cached = (row.get(f"{kind}_etag"), _decode_snapshot(model, row, kind))
+        _cache_put(cache_key, cached)
+
+    etag, snapshot = cached
+    if etag is not None:
+        headers["ETag"] = f'"{etag}"'
+    if _etag_matches(request, etag):
+        return Response(status_code=304, headers=headers)
+    response.headers.update(headers)
+    return snapshot
 
-    graph_json = res.data[0]["graph_json"]
-    logger.info(f"Fetched graph for repo {repo_id}")
-    return RepoGraph.model_validate(graph_json)
\ No newline at end of file
+
+@router.get("/repos/{repo_id}/tree", response_model=TreeNode)
+async def get_repo_tree(
+    repo_id: str,
+    request: Request,
+    response: Response,
+    supabase: AsyncClient = Depends(get_supabase_client),
+) -> TreeNode:
+    """
+    Fetch the most recent tree snapshot for a repo.
+    """
+    return await _get_snapshot(request, response, supabase, repo_id, "tree", TreeNode)
+
+
+@router.get("/repos/{repo_id}/graph", response_model=RepoGraph)
+async def get_repo_graph(
+    repo_id: str,
+    request: Request,
+    response: Response,
+    supabase: AsyncClient = Depends(get_supabase_client),
+) -> RepoGraph:
+    """
+    Fetch the most recent graph snapshot for a repo.
+    """
+    return await _get_snapshot(request, response, supabase, repo_id, "graph", RepoGraph)
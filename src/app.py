@@ -1,10 +1,25 @@
+from contextlib import asynccontextmanager
+
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from api.chat_api import router as chat_router
 from api.repos_api import router as repos_router
+from core.agent import GitHistoryAgent, close_openai_client
+from supabase_client import close_supabase_client
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Built once at startup; handlers receive it through `api.chat_api.get_agent`.
+    app.state.agent = GitHistoryAgent()
+    yield
+    # Release the shared OpenAI and Supabase connection pools on shutdown.
+    await close_openai_client()
+    await close_supabase_client()
+
 
-app = FastAPI(title="Andromeda backend")
+app = FastAPI(title="Andromeda backend", lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
@@ -15,6 +30,8 @@ app.add_middleware(
     allow_credentials=False,
     allow_methods=["*"],
     allow_headers=["*"],
+    # Lets the browser read the pagination cursor of `GET /api/repos`.
+    expose_headers=["X-Next-Cursor"],
 )
 
 app.include_router(chat_router)
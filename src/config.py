@@ -7,7 +7,10 @@ from typing import Optional
 
 from dotenv import load_dotenv
 
-load_dotenv()
+# Deployments that inject configuration through the environment set
+# SKIP_DOTENV to avoid looking for a .env file at startup.
+if not os.getenv("SKIP_DOTENV"):
+    load_dotenv()
 
 
 @dataclass
@@ -23,12 +26,20 @@ class Settings:
     """
     openai_api_key: str
     repo_base_dir: Path
+    cache_dir: Path
 
     supabase_url: Optional[str] = None
     supabase_anon_key: Optional[str] = None
     supabase_service_role_key: Optional[str] = None
     demo_org_id: Optional[str] = None
 
+    # Maximum number of git operations the agent runs at once.
+    git_concurrency: int = 8
+
+    # A repo left in 'cloning' longer than this is assumed abandoned (e.g. the
+    # worker running its ingestion died) and may be re-ingested.
+    ingest_timeout_seconds: float = 1800.0
+
     @classmethod
     def from_env(cls) -> "Settings":
         # --- OpenAI API key (required) ---
@@ -48,19 +59,34 @@ class Settings:
         repo_base_dir = Path(repo_base_dir_str).expanduser().resolve()
         repo_base_dir.mkdir(parents=True, exist_ok=True)
 
+        # --- Cache directory (shared across worker processes) ---
+        cache_dir = Path(os.getenv("CACHE_DIR") or "./data/cache").expanduser().resolve()
+        cache_dir.mkdir(parents=True, exist_ok=True)
+
         # --- Supabase (optional for now) ---
         supabase_url = os.getenv("SUPABASE_URL") or None
         supabase_anon_key = os.getenv("SUPABASE_ANON_KEY") or None
         supabase_service_role_key = os.getenv("SUPABASE_SERVICE_ROLE_KEY") or None
         demo_org_id = os.getenv("DEMO_ORG_ID") or None
 
+        # --- Agent git concurrency ---
+        git_concurrency = int(os.getenv("GIT_AGENT_CONCURRENCY") or 0) or min(
+            32, (os.cpu_count() or 4) * 2
+        )
+
+        # --- Ingestion timeout ---
+        ingest_timeout_seconds = float(os.getenv("INGEST_TIMEOUT_SECONDS") or 1800)
+
         return cls(
             openai_api_key=openai_api_key,
             repo_base_dir=repo_base_dir,
+            cache_dir=cache_dir,
             supabase_url=supabase_url,
             supabase_anon_key=supabase_anon_key,
             supabase_service_role_key=supabase_service_role_key,
             demo_org_id=demo_org_id,
+            git_concurrency=git_concurrency,
+            ingest_timeout_seconds=ingest_timeout_seconds,
         )
 
 
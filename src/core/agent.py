@@ -1,12 +1,26 @@
 from __future__ import annotations
 
-import json
-from typing import Any, Dict, List
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from operator import itemgetter
+from typing import Any, AsyncIterator, Callable, Dict, FrozenSet, List, Set, Tuple, Type, TypeVar
 
-from dotenv import load_dotenv
-from openai import OpenAI
+import httpx
+import orjson
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient, OpenAIError
+from pydantic import BaseModel
 
+from config import settings
+from core.answer_cache import SemanticAnswerCache, is_cacheable_question, question_literals
+from core.git_core import GitError, resolve_commit_sha
 from core.models import BlockRef
+from core.result_store import get_tool_result_store
 from core.tools import (
     GetCodeContextInput,
     GetHistoryContextInput,
@@ -15,176 +29,970 @@ from core.tools import (
 )
 
 
-load_dotenv()
+logger = logging.getLogger(__name__)
+
+
+# Static prompt and tool schema, built once at import time rather than per request.
+_SYSTEM_PROMPT = (
+    "You are a code history assistant. "
+    "You answer questions about a specific block of code. "
+    "The backend will give you the repo, file path, and line range. "
+    "When you need details, call the available tools to fetch:\n"
+    "- The current code and its surrounding context\n"
+    "- Git blame information and commit history for the block.\n\n"
+    "Use tools when needed instead of guessing. "
+    "Reference line numbers and commits when useful."
+)
+
+_TOOL_DEFINITIONS: List[Dict[str, Any]] = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_code_context",
+            "description": (
+                "Fetch code and surrounding context for the current block of code. "
+                "The backend already knows which block is in focus; you only need to "
+                "choose how many lines of surrounding context to include."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "context_lines": {
+                        "type": "integer",
+                        "minimum": 0,
+                        "default": 10,
+                        "description": "Number of lines to include above and below the block.",
+                    }
+                },
+                "required": [],
+            },
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "get_history_context",
+            "description": (
+                "Fetch git blame and commit history for the current block of code. "
+                "The backend already knows which block is in focus; you only need to "
+                "choose how many distinct commits to include."
+            ),
+            "parameters": {
+                "type": "object",
+                "properties": {
+                    "max_commits": {
+                        "type": "integer",
+                        "minimum": 1,
+                        "default": 10,
+                        "description": "Maximum number of commits to include in the history.",
+                    }
+                },
+                "required": [],
+            },
+        },
+    },
+]
+
+_BLOCK_DESCRIPTION_TEMPLATE = (
+    "You are analyzing this specific block of code in a git repository.\n"
+    "repo_owner: {repo_owner}\n"
+    "repo_name: {repo_name}\n"
+    "ref: {ref}\n"
+    "path: {path}\n"
+    "lines: {start_line}-{end_line}\n\n"
+    "Use the tools to fetch code and history for THIS block only."
+)
+
+
+# Tool name -> (input model, implementation). Input models supply the argument
+# defaults and validation, so dispatch is a single lookup.
+_TOOL_DISPATCH: Dict[str, Tuple[Type[BaseModel], Callable[[Any], BaseModel]]] = {
+    "get_code_context": (GetCodeContextInput, get_code_context_tool),
+    "get_history_context": (GetHistoryContextInput, get_history_context_tool),
+}
+
+# Default arguments for each tool, used to normalize tool-call arguments so that
+# `{}` and `{"context_lines": 10}` are recognized as the same call.
+_TOOL_DEFAULTS: Dict[str, Dict[str, Any]] = {
+    "get_code_context": {"context_lines": 10},
+    "get_history_context": {"max_commits": 10},
+}
+
+# Tool calls virtually every answer needs. They are run up front and their results
+# injected into the prompt, so the model can often answer without a tool round-trip.
+_PRELOADED_TOOL_CALLS: List[Tuple[str, Dict[str, Any]]] = [
+    ("get_code_context", {}),
+    ("get_history_context", {}),
+]
+
+# Once every one of these has been called, the next turn must produce an answer.
+_SUFFICIENT_TOOLS: FrozenSet[str] = frozenset({"get_code_context", "get_history_context"})
+
+# Tool results that are superseded or over budget are replaced by a compact
+# reference: a one-line summary plus a hint that re-calling the tool is cheap.
+_COMPACT_RESULT_PREFIX = '{"elided":'
+_COMPACT_RESULT_NOTE = "Call the tool again to re-fetch; results are cached."
+
+# The preloaded-context system message; truncated (never dropped) when the
+# prompt is still over budget after older tool results are compacted.
+_PRELOAD_PREFIX = "Preloaded "
+_PRELOAD_TRUNCATED_NOTE = "\n[truncated; call the tool to fetch the rest]"
+
+# Rough chars-per-token ratio used to estimate prompt size without a tokenizer.
+_CHARS_PER_TOKEN = 4
+
+
+# Process-wide LRU of tool results. Keys include the commit SHA that `ref`
+# resolved to, so a branch that moves never serves stale results. Values are
+# `(expires_at, result)` with `expires_at` on the monotonic clock, or None.
+_TOOL_CACHE_MAXSIZE = 256
+_TOOL_CACHE: "OrderedDict[Tuple[Any, ...], Tuple[float | None, str]]" = OrderedDict()
+
+# Cache lifetime per tool in seconds; None means no expiry. Code at a pinned
+# commit never changes. History gets a TTL so enrichments sourced outside git
+# (e.g. PR discussions) are eventually refreshed. Tools missing here, such as
+# anything with side effects, are never cached.
+_TOOL_CACHE_TTLS: Dict[str, float | None] = {
+    "get_code_context": None,
+    "get_history_context": 3600.0,
+}
+
+# Final answers shared across requests, matched by question embedding.
+_ANSWER_CACHE = SemanticAnswerCache()
+_EMBEDDING_MODEL = "text-embedding-3-small"
+
+# Answers currently being generated, so identical concurrent questions about the
+# same block share one agent run instead of each paying for the LLM round-trips.
+_ANSWER_INFLIGHT: "Dict[Tuple[Any, ...], asyncio.Future[str]]" = {}
+
+# Tool calls currently executing, so identical concurrent calls share one run.
+_TOOL_INFLIGHT: "Dict[Tuple[Any, ...], asyncio.Future[str]]" = {}
+
+# Git work runs on a bounded pool so bursts of questions can't fork an
+# unbounded number of git processes.
+_GIT_EXECUTOR = ThreadPoolExecutor(
+    max_workers=settings.git_concurrency,
+    thread_name_prefix="git-agent",
+)
+
+_T = TypeVar("_T")
+
+
+async def _run_in_git_pool(fn: Callable[..., _T], *args: Any) -> _T:
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(_GIT_EXECUTOR, fn, *args)
+
+
+# One OpenAI client (and connection pool) shared by every agent in the process,
+# so new agents reuse warm HTTP/2 connections instead of doing fresh TLS handshakes.
+_CLIENT: AsyncOpenAI | None = None
+
+# Transient failures (429, 408/409, 5xx, connection errors) are retried by the SDK
+# with exponential backoff that honours Retry-After, so a rate-limit blip does not
+# throw away the tool work already done for the current answer.
+_OPENAI_MAX_RETRIES = 5
+
+
+def get_openai_client() -> AsyncOpenAI:
+    global _CLIENT
+    if _CLIENT is None:
+        _CLIENT = AsyncOpenAI(
+            max_retries=_OPENAI_MAX_RETRIES,
+            http_client=DefaultAsyncHttpxClient(
+                http2=True,
+                limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+            )
+        )
+    return _CLIENT
+
+
+async def close_openai_client() -> None:
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.close()
+        _CLIENT = None
+
+
+# History results are sent as line-delimited JSON with abbreviated keys; this
+# header line is the first line of every such result.
+_HISTORY_HEADER = orjson.dumps(
+    {
+        "format": "line 2 is blame, each following line is one commit",
+        "blame": {"rows": "[line, commit, code]", "commits": "commit -> [author, time, summary]"},
+        "keys": {
+            "a": "author",
+            "ae": "author_email",
+            "t": "date as unix epoch seconds",
+            "m": "message (truncated)",
+            "h": "diff hunks for the block",
+            "pr": "PR numbers",
+        },
+    }
+).decode()
+_HISTORY_MESSAGE_CHARS = 200
+_HISTORY_SHA_CHARS = 12
+
+
+def _to_epoch(value: str | None) -> int | str | None:
+    # Blame reports epoch seconds; `git show` reports the default `%ad` format.
+    if value is None or value.isdigit():
+        return None if value is None else int(value)
+    try:
+        return int(datetime.strptime(value, "%a %b %d %H:%M:%S %Y %z").timestamp())
+    except ValueError:
+        return value
+
+
+# Fields read from each dumped blame entry / commit, fetched in one call.
+_BLAME_FIELDS = itemgetter("line", "commit", "code", "author", "author_time", "summary")
+_COMMIT_FIELDS = itemgetter(
+    "sha", "author", "author_email", "date", "message", "diff_hunks_for_block", "pr_numbers"
+)
+
+
+def _compact_history(data: Dict[str, Any]) -> str:
+    """
+    Re-encode a dumped HistoryContext as compact NDJSON for the model.
+
+    The block ref is dropped (the model already has it), blame metadata is
+    stored once per commit instead of per line, SHAs are abbreviated, dates
+    become epoch ints, messages are truncated and null fields are omitted.
+    """
+    rows: List[List[Any]] = []
+    blame_commits: Dict[str, List[Any]] = {}
+    for entry in (data.get("blame") or {}).get("entries") or []:
+        line, sha, code, author, author_time, summary = _BLAME_FIELDS(entry)
+        sha = sha[:_HISTORY_SHA_CHARS]
+        rows.append([line, sha, code])
+        if sha not in blame_commits:
+            blame_commits[sha] = [author, _to_epoch(author_time), summary]
+
+    lines = [_HISTORY_HEADER, orjson.dumps({"rows": rows, "commits": blame_commits}).decode()]
+    for commit in data.get("commits") or []:
+        sha, author, author_email, date, message, hunks, pr_numbers = _COMMIT_FIELDS(commit)
+        compact = {
+            "sha": sha[:_HISTORY_SHA_CHARS],
+            "a": author,
+            "ae": author_email,
+            "t": _to_epoch(date),
+            "m": message[:_HISTORY_MESSAGE_CHARS],
+            "h": hunks,
+            "pr": pr_numbers,
+        }
+        lines.append(orjson.dumps({k: v for k, v in compact.items() if v is not None}).decode())
+    return "\n".join(lines)
+
+
+# Tool name -> encoder for the tool message content, for tools whose results
+# benefit from a denser encoding than their model's JSON dump.
+_TOOL_RESULT_ENCODERS: Dict[str, Callable[[Dict[str, Any]], str]] = {
+    "get_history_context": _compact_history,
+}
+
+
+def _summarize_tool_result(name: str, content: str) -> str:
+    try:
+        if name == "get_code_context":
+            data = orjson.loads(content)
+            return (
+                f"{data['block_ref']['path']} lines "
+                f"{data['context_start_line']}-{data['context_end_line']}"
+            )
+        if name == "get_history_context":
+            lines = content.splitlines()
+            blame_lines = len(orjson.loads(lines[1])["rows"])
+            return f"{len(lines) - 2} commits, blame for {blame_lines} lines"
+    except (orjson.JSONDecodeError, IndexError, KeyError, TypeError):
+        pass
+    return f"{len(content)} characters of JSON"
+
+
+def _compact_tool_result(name: str, content: str, reason: str) -> str:
+    return orjson.dumps(
+        {
+            "elided": reason,
+            "tool": name,
+            "summary": _summarize_tool_result(name, content),
+            "note": _COMPACT_RESULT_NOTE,
+        }
+    ).decode()
+
+
+def _block_key(block_ref: BlockRef, commit_sha: str) -> Tuple[Any, ...]:
+    # Identifies a block's content: the ref is replaced by the commit it
+    # resolved to, so keys for a branch miss as soon as it moves.
+    return (
+        block_ref.repo_owner,
+        block_ref.repo_name,
+        commit_sha,
+        block_ref.path,
+        block_ref.start_line,
+        block_ref.end_line,
+    )
+
+
+# Injected once when the tool-time budget runs out, before forcing a final answer.
+_TOOL_BUDGET_EXHAUSTED = "You have exhausted the tool budget; answer from what you have."
+
+
+class _ToolLoopState:
+    """
+    Per-answer bookkeeping for the tool loop's iteration and time budgets.
+    """
+
+    def __init__(self) -> None:
+        self.tools_called: Set[str] = set()
+        self.turns = 0
+        self.seconds = 0.0
+        self.out_of_time = False
 
 
 class GitHistoryAgent:
-    def __init__(self, model: str = "gpt-4.1-mini"):
-        self.client = OpenAI()
+    def __init__(
+        self,
+        model: str = "gpt-4.1-mini",
+        max_tokens: int = 1024,
+        max_tool_iterations: int = 3,
+        max_prompt_tokens: int = 16000,
+        max_tool_seconds: float = 20.0,
+    ):
+        self.client = get_openai_client()
         self.model = model
+        # Upper bound on tokens generated per completion turn.
+        self.max_tokens = max_tokens
+        # Tool-calling turns allowed before the model is forced to answer.
+        self.max_tool_iterations = max_tool_iterations
+        # Cumulative tool wall time allowed before the model is forced to answer.
+        self.max_tool_seconds = max_tool_seconds
+        # Approximate prompt budget; older tool results are elided to stay under it.
+        self.max_prompt_tokens = max_prompt_tokens
 
     def build_system_prompt(self) -> str:
-        return (
-            "You are a code history assistant. "
-            "You answer questions about a specific block of code. "
-            "The backend will give you the repo, file path, and line range. "
-            "When you need details, call the available tools to fetch:\n"
-            "- The current code and its surrounding context\n"
-            "- Git blame information and commit history for the block.\n\n"
-            "Use tools when needed instead of guessing. "
-            "Reference line numbers and commits when useful."
-        )
+        return _SYSTEM_PROMPT
 
     def _tool_definitions(self) -> List[Dict[str, Any]]:
-        return [
-            {
-                "type": "function",
-                "function": {
-                    "name": "get_code_context",
-                    "description": (
-                        "Fetch code and surrounding context for the current block of code. "
-                        "The backend already knows which block is in focus; you only need to "
-                        "choose how many lines of surrounding context to include."
-                    ),
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "context_lines": {
-                                "type": "integer",
-                                "minimum": 0,
-                                "default": 10,
-                                "description": "Number of lines to include above and below the block.",
-                            }
-                        },
-                        "required": [],
-                    },
-                },
-            },
-            {
-                "type": "function",
-                "function": {
-                    "name": "get_history_context",
-                    "description": (
-                        "Fetch git blame and commit history for the current block of code. "
-                        "The backend already knows which block is in focus; you only need to "
-                        "choose how many distinct commits to include."
-                    ),
-                    "parameters": {
-                        "type": "object",
-                        "properties": {
-                            "max_commits": {
-                                "type": "integer",
-                                "minimum": 1,
-                                "default": 10,
-                                "description": "Maximum number of commits to include in the history.",
-                            }
-                        },
-                        "required": [],
-                    },
-                },
-            },
-        ]
+        return _TOOL_DEFINITIONS
+
+    @staticmethod
+    def _tool_call_key(
+        name: str,
+        arguments: Dict[str, Any],
+    ) -> Tuple[str, FrozenSet[Tuple[str, Any]]] | None:
+        merged = {**_TOOL_DEFAULTS.get(name, {}), **arguments}
+        try:
+            return name, frozenset(merged.items())
+        except TypeError:
+            # Unhashable argument values; such calls are never cached.
+            return None
 
-    def _execute_tool(
+    async def _execute_tool(
         self,
         name: str,
         arguments: Dict[str, Any],
         block_ref: BlockRef,
-    ) -> Dict[str, Any]:
-        if name == "get_code_context":
-            context_lines = arguments.get("context_lines", 10)
-            result = get_code_context_tool(
-                GetCodeContextInput(
-                    block_ref=block_ref,
-                    context_lines=context_lines,
-                )
-            )
-            return result.model_dump()
+    ) -> str:
+        call_key = self._tool_call_key(name, arguments)
+        try:
+            commit_sha = await _run_in_git_pool(resolve_commit_sha, block_ref)
+        except GitError:
+            # Let the tool itself report the bad ref/repo; just don't cache.
+            commit_sha = None
+        else:
+            # Run the tool at the commit its result is cached under, so a
+            # branch moving mid-request can't mix up key and content (and
+            # git_core can reuse file contents at that commit).
+            block_ref = block_ref.model_copy(update={"ref": commit_sha})
 
-        if name == "get_history_context":
-            max_commits = arguments.get("max_commits", 10)
-            result = get_history_context_tool(
-                GetHistoryContextInput(
-                    block_ref=block_ref,
-                    max_commits=max_commits,
-                )
+        cache_key = None
+        if call_key is not None and commit_sha is not None and name in _TOOL_CACHE_TTLS:
+            cache_key = (*_block_key(block_ref, commit_sha), *call_key)
+            cached = _TOOL_CACHE.get(cache_key)
+            if cached is not None:
+                expires_at, value = cached
+                if expires_at is None or expires_at > time.monotonic():
+                    _TOOL_CACHE.move_to_end(cache_key)
+                    return value
+                del _TOOL_CACHE[cache_key]
+
+        if cache_key is None:
+            return await self._run_tool(name, arguments, block_ref)
+
+        inflight = _TOOL_INFLIGHT.get(cache_key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(
+                self._load_or_run_tool(cache_key, name, arguments, block_ref)
             )
-            return result.model_dump()
+            _TOOL_INFLIGHT[cache_key] = inflight
+            inflight.add_done_callback(lambda _: _TOOL_INFLIGHT.pop(cache_key, None))
+
+        # Shield so one cancelled waiter doesn't cancel the run for the others.
+        result = await asyncio.shield(inflight)
 
-        raise ValueError(f"Unknown tool: {name}")
+        ttl = _TOOL_CACHE_TTLS[name]
+        expires_at = None if ttl is None else time.monotonic() + ttl
+        _TOOL_CACHE[cache_key] = (expires_at, result)
+        if len(_TOOL_CACHE) > _TOOL_CACHE_MAXSIZE:
+            _TOOL_CACHE.popitem(last=False)
+        return result
 
-    def answer_question(
+    async def _load_or_run_tool(
         self,
+        cache_key: Tuple[Any, ...],
+        name: str,
+        arguments: Dict[str, Any],
         block_ref: BlockRef,
-        question: str,
     ) -> str:
-        tools = self._tool_definitions()
+        # Second-tier lookup in the store shared by all worker processes.
+        *block_key, tool_name, frozen_args = cache_key
+        store_key = orjson.dumps([*block_key, tool_name, sorted(frozen_args)]).decode()
+
+        # The store is only a cache: if SQLite fails (locked by another
+        # worker, disk full, read-only CACHE_DIR) just run the tool.
+        store = None
+        try:
+            store = get_tool_result_store()
+            stored = await asyncio.to_thread(store.get, store_key)
+        except sqlite3.Error as e:
+            logger.warning("Tool result store read failed: %s", e)
+            stored = None
+        if stored is not None:
+            return stored
 
-        block_description = (
-            "You are analyzing this specific block of code in a git repository.\n"
-            f"repo_owner: {block_ref.repo_owner}\n"
-            f"repo_name: {block_ref.repo_name}\n"
-            f"ref: {block_ref.ref}\n"
-            f"path: {block_ref.path}\n"
-            f"lines: {block_ref.start_line}-{block_ref.end_line}\n\n"
-            "Use the tools to fetch code and history for THIS block only."
+        result = await self._run_tool(name, arguments, block_ref)
+        if store is not None:
+            try:
+                await asyncio.to_thread(store.set, store_key, result, _TOOL_CACHE_TTLS[name])
+            except sqlite3.Error as e:
+                logger.warning("Tool result store write failed: %s", e)
+        return result
+
+    async def _run_tool(
+        self,
+        name: str,
+        arguments: Dict[str, Any],
+        block_ref: BlockRef,
+    ) -> str:
+        # Results are returned as the tool message content: JSON text serialized
+        # once by pydantic-core, or a tool-specific compact encoding.
+        # Tools shell out to git, so run them on the git pool to keep the
+        # event loop free and let sibling tool calls overlap.
+        try:
+            input_model, fn = _TOOL_DISPATCH[name]
+        except KeyError:
+            raise ValueError(f"Unknown tool: {name}") from None
+
+        params = input_model(**{**arguments, "block_ref": block_ref})
+        result = await _run_in_git_pool(fn, params)
+        encoder = _TOOL_RESULT_ENCODERS.get(name)
+        if encoder is not None:
+            return encoder(result.model_dump())
+        return result.model_dump_json()
+
+    async def _initial_messages(
+        self,
+        block_ref: BlockRef,
+        question: str,
+    ) -> List[Dict[str, Any]]:
+        """
+        Build the opening messages, laid out for OpenAI prompt caching.
+
+        Everything that is identical across questions about the same block
+        comes first (system prompt, block description, preloaded context) and
+        the question comes last, so repeat questions reuse the cached prefix.
+        Keep timestamps, request ids and other per-request values out of the
+        prefix, or every request becomes a cache miss.
+        """
+        block_description = _BLOCK_DESCRIPTION_TEMPLATE.format(
+            repo_owner=block_ref.repo_owner,
+            repo_name=block_ref.repo_name,
+            ref=block_ref.ref,
+            path=block_ref.path,
+            start_line=block_ref.start_line,
+            end_line=block_ref.end_line,
         )
 
         messages: List[Dict[str, Any]] = [
             {"role": "system", "content": self.build_system_prompt()},
             {"role": "user", "content": block_description},
-            {"role": "user", "content": question},
         ]
 
-        while True:
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=messages,
-                tools=tools,
-                tool_choice="auto",
+        # Failures are left for the model to hit through the regular tool call,
+        # which reports them the same way as before preloading existed.
+        results = await asyncio.gather(
+            *(self._execute_tool(name, args, block_ref) for name, args in _PRELOADED_TOOL_CALLS),
+            return_exceptions=True,
+        )
+        preloaded = [
+            f"{_PRELOAD_PREFIX}{name} (default arguments):\n{result}"
+            for (name, _), result in zip(_PRELOADED_TOOL_CALLS, results)
+            if not isinstance(result, BaseException)
+        ]
+        if preloaded:
+            messages.append({"role": "system", "content": "\n\n".join(preloaded)})
+
+        if logger.isEnabledFor(logging.DEBUG):
+            # Same block and commit should always log the same digest; if it
+            # changes, something per-request leaked into the cached prefix.
+            prefix = orjson.dumps(messages)
+            logger.debug(
+                "Prompt prefix for %s: %d bytes, digest %s",
+                self._prompt_cache_key(block_ref),
+                len(prefix),
+                hashlib.blake2b(prefix, digest_size=8).hexdigest(),
+            )
+
+        messages.append({"role": "user", "content": question})
+        return messages
+
+    async def _dispatch_tool_calls(
+        self,
+        block_ref: BlockRef,
+        messages: List[Dict[str, Any]],
+        tool_calls: List[Dict[str, Any]],
+    ) -> None:
+        """
+        Execute one assistant turn's tool calls and append their results to `messages`.
+
+        `tool_calls` uses the chat-completions wire shape
+        (`{"id", "type", "function": {"name", "arguments"}}`).
+        """
+        coros = []
+        for tc in tool_calls:
+            name = tc["function"]["name"]
+            raw_args = tc["function"]["arguments"] or "{}"
+            try:
+                args = orjson.loads(raw_args)
+            except orjson.JSONDecodeError:
+                args = {}
+            coros.append(self._execute_tool(name, args, block_ref))
+
+        # All tool calls from one assistant turn run concurrently; wait for
+        # every one of them before surfacing the first failure.
+        results = await asyncio.gather(*coros, return_exceptions=True)
+        for result in results:
+            if isinstance(result, BaseException):
+                raise result
+
+        # A newer call to the same tool supersedes earlier output; stub the old
+        # payloads so later turns don't keep re-sending them as prompt tokens.
+        called = {tc["function"]["name"] for tc in tool_calls}
+        for msg in messages:
+            if msg.get("role") == "tool" and msg.get("name") in called:
+                if not msg["content"].startswith(_COMPACT_RESULT_PREFIX):
+                    msg["content"] = _compact_tool_result(msg["name"], msg["content"], "superseded")
+
+        for tc, result in zip(tool_calls, results):
+            messages.append(
+                {
+                    "role": "tool",
+                    "tool_call_id": tc["id"],
+                    "name": tc["function"]["name"],
+                    "content": result,
+                }
+            )
+
+        self._trim_to_token_budget(messages)
+
+    def _trim_to_token_budget(self, messages: List[Dict[str, Any]]) -> None:
+        """
+        Shrink the prompt until it fits `max_prompt_tokens`.
+
+        Results from the latest tool turn are never touched. Older tool
+        results are compacted oldest-first; if that is not enough, the
+        preloaded-context message is truncated. No message is removed or
+        reordered, so tool_call ids stay paired.
+        """
+        budget = self.max_prompt_tokens * _CHARS_PER_TOKEN
+        total = sum(len(msg.get("content") or "") for msg in messages)
+
+        latest = len(messages)
+        while latest > 0 and messages[latest - 1].get("role") == "tool":
+            latest -= 1
+
+        for msg in messages[:latest]:
+            if total <= budget:
+                return
+            if msg.get("role") != "tool" or msg["content"].startswith(_COMPACT_RESULT_PREFIX):
+                continue
+            compact = _compact_tool_result(msg["name"], msg["content"], "over_budget")
+            total -= len(msg["content"]) - len(compact)
+            msg["content"] = compact
+
+        if total <= budget:
+            return
+        for msg in messages[:latest]:
+            content = msg.get("content") or ""
+            if msg.get("role") == "system" and content.startswith(_PRELOAD_PREFIX):
+                body = content.removesuffix(_PRELOAD_TRUNCATED_NOTE)
+                # Keep at least the header line so the message stays recognisable.
+                floor = content.find("\n") + 1 or len(_PRELOAD_PREFIX)
+                keep = max(len(content) - (total - budget) - len(_PRELOAD_TRUNCATED_NOTE), floor)
+                if keep < len(body):
+                    msg["content"] = body[:keep] + _PRELOAD_TRUNCATED_NOTE
+                return
+
+    async def _create_completion(
+        self,
+        messages: List[Dict[str, Any]],
+        tools: List[Dict[str, Any]],
+        tool_choice: str = "auto",
+        **kwargs: Any,
+    ) -> Any:
+        return await self.client.chat.completions.create(
+            model=self.model,
+            messages=messages,
+            tools=tools,
+            tool_choice=tool_choice,
+            parallel_tool_calls=True,
+            max_tokens=self.max_tokens,
+            **kwargs,
+        )
+
+    @staticmethod
+    def _prompt_cache_key(block_ref: BlockRef) -> str:
+        # Routes requests about the same block to the same prompt-cache shard.
+        return (
+            f"{block_ref.repo_owner}/{block_ref.repo_name}@{block_ref.ref}:"
+            f"{block_ref.path}:{block_ref.start_line}-{block_ref.end_line}"
+        )
+
+    def _tool_choice(self, state: _ToolLoopState) -> str:
+        if _SUFFICIENT_TOOLS <= state.tools_called:
+            logger.info("All context tools called; forcing a final answer")
+            return "none"
+        if state.turns >= self.max_tool_iterations:
+            logger.info("Tool iteration limit (%d) reached; forcing a final answer", state.turns)
+            return "none"
+        if state.out_of_time:
+            return "none"
+        return "auto"
+
+    async def _run_tool_turn(
+        self,
+        block_ref: BlockRef,
+        messages: List[Dict[str, Any]],
+        tool_calls: List[Dict[str, Any]],
+        state: _ToolLoopState,
+    ) -> None:
+        started = time.perf_counter()
+        await self._dispatch_tool_calls(block_ref, messages, tool_calls)
+        state.seconds += time.perf_counter() - started
+        state.tools_called.update(tc["function"]["name"] for tc in tool_calls)
+        state.turns += 1
+
+        if not state.out_of_time and state.seconds > self.max_tool_seconds:
+            logger.info(
+                "Tool time budget exhausted (%.1fs > %.1fs); forcing a final answer",
+                state.seconds,
+                self.max_tool_seconds,
+            )
+            state.out_of_time = True
+            messages.append({"role": "system", "content": _TOOL_BUDGET_EXHAUSTED})
+
+    def _warn_if_truncated(self, finish_reason: str | None) -> None:
+        if finish_reason == "length":
+            logger.warning("Completion truncated at max_tokens=%d", self.max_tokens)
+
+    async def _answer_cache_entry(
+        self,
+        block_ref: BlockRef,
+        question: str,
+    ) -> Tuple[Tuple[Any, ...], List[float]] | None:
+        """
+        Return `(cache_key, question_embedding)` for the answer cache, or None
+        when this question must not be served from or stored in the cache.
+
+        The key pins the model and the question's literal tokens (numbers,
+        SHAs, identifiers), so only the remaining wording is matched by
+        embedding similarity.
+        """
+        if not is_cacheable_question(question):
+            return None
+        try:
+            commit_sha, embedding = await asyncio.gather(
+                _run_in_git_pool(resolve_commit_sha, block_ref),
+                self.client.embeddings.create(model=_EMBEDDING_MODEL, input=question),
+            )
+        except (GitError, OpenAIError):
+            return None
+        cache_key = (self.model, *_block_key(block_ref, commit_sha), question_literals(question))
+        return cache_key, embedding.data[0].embedding
+
+    async def _prepare(
+        self,
+        block_ref: BlockRef,
+        question: str,
+    ) -> Tuple[Tuple[Tuple[Any, ...], List[float]] | None, str | None, List[Dict[str, Any]]]:
+        # The cache probe and the context preload overlap; on a hit the
+        # preloaded tool results still land in the tool cache for later.
+        cache_entry, messages = await asyncio.gather(
+            self._answer_cache_entry(block_ref, question),
+            self._initial_messages(block_ref, question),
+        )
+        cached = _ANSWER_CACHE.lookup(*cache_entry) if cache_entry is not None else None
+        return cache_entry, cached, messages
+
+    async def warmup(self, block_ref: BlockRef) -> None:
+        """
+        Run the preloaded tool calls for a block ahead of its first question.
+
+        Results land in the same caches `_initial_messages` reads, so the
+        first question skips the git work. Failures are ignored here; a later
+        question reports them as usual.
+        """
+        await asyncio.gather(
+            *(self._execute_tool(name, args, block_ref) for name, args in _PRELOADED_TOOL_CALLS),
+            return_exceptions=True,
+        )
+
+    async def answer_question(
+        self,
+        block_ref: BlockRef,
+        question: str,
+    ) -> str:
+        key = (self.model, block_ref, " ".join(question.lower().split()))
+        inflight = _ANSWER_INFLIGHT.get(key)
+        if inflight is None:
+            inflight = asyncio.ensure_future(self._answer_question(block_ref, question))
+            _ANSWER_INFLIGHT[key] = inflight
+            inflight.add_done_callback(lambda _: _ANSWER_INFLIGHT.pop(key, None))
+
+        # Shield so one disconnected caller doesn't cancel the run for the others.
+        return await asyncio.shield(inflight)
+
+    async def _answer_question(
+        self,
+        block_ref: BlockRef,
+        question: str,
+    ) -> str:
+        cache_entry, cached, messages = await self._prepare(block_ref, question)
+        if cached is not None:
+            return cached
+
+        answer = await self._run_completion_loop(block_ref, messages)
+        if cache_entry is not None and answer:
+            _ANSWER_CACHE.store(*cache_entry, answer)
+        return answer
+
+    async def _run_completion_loop(
+        self,
+        block_ref: BlockRef,
+        messages: List[Dict[str, Any]],
+    ) -> str:
+        tools = self._tool_definitions()
+        state = _ToolLoopState()
+
+        # One completion per allowed tool turn, plus the forced final answer.
+        for _ in range(self.max_tool_iterations + 1):
+            response = await self._create_completion(
+                messages,
+                tools,
+                self._tool_choice(state),
+                prompt_cache_key=self._prompt_cache_key(block_ref),
             )
 
-            message = response.choices[0].message
+            choice = response.choices[0]
+            message = choice.message
+            if choice.finish_reason == "stop":
+                return message.content or ""
+            self._warn_if_truncated(choice.finish_reason)
 
-            tool_calls = getattr(message, "tool_calls", None)
+            tool_calls = message.tool_calls
             if tool_calls:
-                messages.append(
-                    {
-                        "role": "assistant",
-                        "tool_calls": [
-                            {
-                                "id": tc.id,
-                                "type": "function",
-                                "function": {
-                                    "name": tc.function.name,
-                                    "arguments": tc.function.arguments,
-                                },
-                            }
-                            for tc in tool_calls
-                        ],
-                    }
-                )
-
-                for tc in tool_calls:
-                    name = tc.function.name
-                    raw_args = tc.function.arguments or "{}"
-                    try:
-                        args = json.loads(raw_args)
-                    except json.JSONDecodeError:
-                        args = {}
-
-                    result = self._execute_tool(name, args, block_ref)
-
-                    messages.append(
-                        {
-                            "role": "tool",
-                            "tool_call_id": tc.id,
-                            "name": name,
-                            "content": json.dumps(result),
-                        }
+                # The SDK message already has the request wire shape; dump only the
+                # fields the API accepts back on an assistant tool-call turn.
+                assistant = message.model_dump(include={"role", "tool_calls"}, exclude_none=True)
+                messages.append(assistant)
+                await self._run_tool_turn(block_ref, messages, assistant["tool_calls"], state)
+                continue
+
+            content = message.content or ""
+            return content
+
+        raise RuntimeError("Agent did not produce an answer within its tool budget")
+
+    async def answer_question_stream(
+        self,
+        block_ref: BlockRef,
+        question: str,
+    ) -> AsyncIterator[str]:
+        """
+        Like `answer_question`, but yields the final answer as it is generated.
+
+        Tool-call turns are accumulated from the stream and executed as usual;
+        only content from the turn that produces the answer is yielded.
+        """
+        cache_entry, cached, messages = await self._prepare(block_ref, question)
+        if cached is not None:
+            yield cached
+            return
+
+        parts: List[str] = []
+        async for part in self._stream_completion_loop(block_ref, messages):
+            parts.append(part)
+            yield part
+
+        answer = "".join(parts)
+        if cache_entry is not None and answer:
+            _ANSWER_CACHE.store(*cache_entry, answer)
+
+    async def _stream_completion_loop(
+        self,
+        block_ref: BlockRef,
+        messages: List[Dict[str, Any]],
+    ) -> AsyncIterator[str]:
+        tools = self._tool_definitions()
+        state = _ToolLoopState()
+
+        # One completion per allowed tool turn, plus the forced final answer.
+        for _ in range(self.max_tool_iterations + 1):
+            tool_choice = self._tool_choice(state)
+            stream = await self._create_completion(
+                messages,
+                tools,
+                tool_choice,
+                prompt_cache_key=self._prompt_cache_key(block_ref),
+                stream=True,
+            )
+
+            # Tool-call fragments arrive spread across chunks, keyed by index.
+            pending: Dict[int, Dict[str, Any]] = {}
+            # A turn that may still end in tool calls is buffered, so narration
+            # from tool-call turns never reaches the caller (or the cache).
+            buffered: List[str] = []
+            async for chunk in stream:
+                if not chunk.choices:
+                    continue
+                self._warn_if_truncated(chunk.choices[0].finish_reason)
+                delta = chunk.choices[0].delta
+
+                for tc in delta.tool_calls or []:
+                    entry = pending.setdefault(
+                        tc.index,
+                        {"id": "", "type": "function", "function": {"name": "", "arguments": ""}},
                     )
+                    if tc.id:
+                        entry["id"] = tc.id
+                    if tc.function is not None:
+                        if tc.function.name:
+                            entry["function"]["name"] += tc.function.name
+                        if tc.function.arguments:
+                            entry["function"]["arguments"] += tc.function.arguments
+
+                if delta.content:
+                    if tool_choice == "none":
+                        yield delta.content
+                    else:
+                        buffered.append(delta.content)
+
+            if not pending:
+                for part in buffered:
+                    yield part
+                return
+
+            wire_tool_calls = [pending[i] for i in sorted(pending)]
+            messages.append({"role": "assistant", "tool_calls": wire_tool_calls})
+            await self._run_tool_turn(block_ref, messages, wire_tool_calls, state)
 
+        raise RuntimeError("Agent did not produce an answer within its tool budget")
+
+    async def answer_questions_batch(
+        self,
+        items: List[Tuple[BlockRef, str]],
+    ) -> List[str]:
+        """
+        Answer several independent questions concurrently.
+
+        Results are returned in the same order as `items`.
+        """
+        return await asyncio.gather(
+            *(self.answer_question(block_ref, question) for block_ref, question in items)
+        )
+
+    async def submit_batch(
+        self,
+        items: List[Tuple[BlockRef, str]],
+    ) -> str:
+        """
+        Submit questions to the OpenAI Batch API for offline, non-latency-sensitive work.
+
+        Batch requests cannot run a tool loop, so each request carries the preloaded
+        code and history context and is answered in a single turn. Returns the
+        batch id; collect the answers with `poll_batch`.
+        """
+        all_messages = await asyncio.gather(
+            *(self._initial_messages(block_ref, question) for block_ref, question in items)
+        )
+        lines = [
+            orjson.dumps(
+                {
+                    "custom_id": str(index),
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": self.model,
+                        "messages": messages,
+                        "tools": self._tool_definitions(),
+                        "tool_choice": "none",
+                        "max_tokens": self.max_tokens,
+                    },
+                }
+            )
+            for index, messages in enumerate(all_messages)
+        ]
+
+        batch_file = await self.client.files.create(
+            file=("batch.jsonl", b"\n".join(lines)),
+            purpose="batch",
+        )
+        batch = await self.client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window="24h",
+        )
+        return batch.id
+
+    async def poll_batch(
+        self,
+        batch_id: str,
+        poll_interval: float = 30.0,
+    ) -> List[str | None]:
+        """
+        Wait for a batch from `submit_batch` to finish and return its answers.
+
+        Answers are in submission order; requests that failed come back as None.
+        """
+        while True:
+            batch = await self.client.batches.retrieve(batch_id)
+            if batch.status == "completed":
+                break
+            if batch.status in {"failed", "expired", "cancelled"}:
+                raise RuntimeError(f"Batch {batch_id} ended with status {batch.status}")
+            await asyncio.sleep(poll_interval)
+
+        total = batch.request_counts.total if batch.request_counts else 0
+        answers: List[str | None] = [None] * total
+        if not batch.output_file_id:
+            return answers
+
+        output = await self.client.files.content(batch.output_file_id)
+        for line in output.content.splitlines():
+            if not line.strip():
                 continue
+            record = orjson.loads(line)
+            response = record.get("response") or {}
+            if response.get("status_code") != 200:
+                continue
+            choices = response["body"]["choices"]
+            answers[int(record["custom_id"])] = choices[0]["message"].get("content") or ""
+        return answers
 
-            content = message.content or ""
-            return content
\ No newline at end of file
+    def answer_question_sync(
+        self,
+        block_ref: BlockRef,
+        question: str,
+    ) -> str:
+        """
+        Blocking wrapper around `answer_question` for callers without an event loop.
+        """
+        return asyncio.run(self.answer_question(block_ref, question))
@@ -0,0 +1,96 @@
+from __future__ import annotations
+
+import math
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, List, Tuple
+
+
+# Questions whose answer depends on when they are asked are never cached.
+_TIME_SENSITIVE_RE = re.compile(
+    r"\b(today|yesterday|tomorrow|now|currently|latest|recent(ly)?|last|"
+    r"this (week|month|year)|\d{4}-\d{2}-\d{2})\b",
+    re.IGNORECASE,
+)
+
+
+# Literal tokens a question can hinge on: quoted code, SHAs, numbers (line
+# numbers, counts) and identifier-shaped words (snake_case, camelCase, dotted).
+# Two questions that differ in any of these must never share an answer, however
+# close their embeddings are.
+_LITERAL_RE = re.compile(
+    r"`[^`]+`"
+    r"|\b[0-9a-fA-F]{7,40}\b"
+    r"|\b\d+\b"
+    r"|\b[A-Za-z_]\w*(?:\.\w+)+\b"
+    r"|\b\w*_\w*\b"
+    r"|\b[a-z]+[A-Z]\w*\b"
+    r"|\b[A-Z][a-z0-9]+[A-Z]\w*\b"
+)
+
+
+def is_cacheable_question(question: str) -> bool:
+    return _TIME_SENSITIVE_RE.search(question) is None
+
+
+def question_literals(question: str) -> Tuple[str, ...]:
+    """Sorted, de-duplicated literal tokens of `question`, for exact matching."""
+    return tuple(sorted({match.strip("`") for match in _LITERAL_RE.findall(question)}))
+
+
+def _cosine(a: List[float], b: List[float]) -> float:
+    dot = sum(x * y for x, y in zip(a, b))
+    norm = math.sqrt(sum(x * x for x in a)) * math.sqrt(sum(y * y for y in b))
+    return dot / norm if norm else 0.0
+
+
+class SemanticAnswerCache:
+    """
+    Cross-request cache of final answers, matched by question embedding.
+
+    Entries are grouped per block key, which includes the resolved commit SHA,
+    so edits to the code naturally miss. Within a block only a handful of
+    questions are ever asked, so a linear cosine scan is enough.
+    """
+
+    def __init__(
+        self,
+        max_blocks: int = 512,
+        max_answers_per_block: int = 16,
+        threshold: float = 0.95,
+    ):
+        self.max_blocks = max_blocks
+        self.max_answers_per_block = max_answers_per_block
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._blocks: "OrderedDict[Tuple[Any, ...], List[Tuple[List[float], str]]]" = OrderedDict()
+
+    def lookup(self, block_key: Tuple[Any, ...], embedding: List[float]) -> str | None:
+        with self._lock:
+            entries = self._blocks.get(block_key)
+            if not entries:
+                return None
+            self._blocks.move_to_end(block_key)
+            best_score, best_answer = max(
+                ((_cosine(embedding, cached), answer) for cached, answer in entries),
+                key=lambda pair: pair[0],
+            )
+        return best_answer if best_score >= self.threshold else None
+
+    def store(self, block_key: Tuple[Any, ...], embedding: List[float], answer: str) -> None:
+        with self._lock:
+            entries = self._blocks.setdefault(block_key, [])
+            self._blocks.move_to_end(block_key)
+            entries.append((embedding, answer))
+            if len(entries) > self.max_answers_per_block:
+                del entries[0]
+            if len(self._blocks) > self.max_blocks:
+                self._blocks.popitem(last=False)
+
+
+__all__ = [
+    "SemanticAnswerCache",
+    "is_cacheable_question",
+    "question_literals",
+]
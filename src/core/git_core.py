@@ -1,8 +1,14 @@
 from __future__ import annotations
 
+import atexit
+import re
 import subprocess
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+from itertools import islice
 from pathlib import Path
-from typing import List, Tuple
+from typing import Dict, Iterable, Iterator, List, Tuple
 
 from config import settings
 from core.models import (
@@ -31,62 +37,286 @@ def get_repos_root() -> Path:
 
 
 def resolve_repo_path(block_ref: BlockRef) -> Path:
+    return _resolve_repo_path(block_ref.repo_name)
+
+
+@lru_cache(maxsize=64)
+def _resolve_repo_path(repo_name: str) -> Path:
+    # Only found repos are cached (lru_cache doesn't keep exceptions), so a
+    # repo cloned after a miss is picked up on the next call.
     root = get_repos_root()
-    repo_path = root  / block_ref.repo_name
+    repo_path = root  / repo_name
     if not repo_path.exists():
         raise GitError(f"Repo path does not exist: {repo_path}")
     return repo_path
 
 
+def clear_cache() -> None:
+    """Forget resolved repo paths and cached files and blame, and stop cat-file processes."""
+    global _FILE_CACHE_CHARS
+    _resolve_repo_path.cache_clear()
+    _close_cat_files()
+    with _FILE_CACHE_LOCK:
+        _FILE_CACHE.clear()
+        _FILE_CACHE_CHARS = 0
+    with _BLAME_CACHE_LOCK:
+        _BLAME_CACHE.clear()
+
+
 def run_git(args: List[str], repo_path: Path) -> str:
     cmd = ["git", *args]
+    # Captured as bytes and decoded once; file content in diffs isn't
+    # guaranteed to be UTF-8.
     result = subprocess.run(
         cmd,
         cwd=str(repo_path),
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE,
-        text=True,
     )
     if result.returncode != 0:
-        raise GitError(f"Git command failed: {' '.join(cmd)}\n{result.stderr.strip()}")
-    return result.stdout
+        stderr = result.stderr.decode(errors="replace")
+        raise GitError(f"Git command failed: {' '.join(cmd)}\n{stderr.strip()}")
+    return result.stdout.decode(errors="replace")
 
 
-def read_file_at_ref(block_ref: BlockRef) -> Tuple[List[str], int]:
+_STREAM_CHUNK_CHARS = 64 * 1024
+
+
+def run_git_stream(args: List[str], repo_path: Path) -> Iterator[str]:
+    """
+    Like `run_git`, but yield stdout in chunks while git is still running.
+
+    Chunks are at most 64K characters and may end mid-line. Closing the
+    iterator early stops the git process.
+    """
+    cmd = ["git", *args]
+    with subprocess.Popen(
+        cmd,
+        cwd=str(repo_path),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        encoding="utf-8",
+        errors="replace",
+    ) as proc:
+        try:
+            yield from iter(lambda: proc.stdout.read(_STREAM_CHUNK_CHARS), "")
+            stderr = proc.stderr.read()
+            returncode = proc.wait()
+        finally:
+            if proc.returncode is None:
+                proc.kill()
+    if returncode != 0:
+        raise GitError(f"Git command failed: {' '.join(cmd)}\n{stderr.strip()}")
+
+
+class _CatFile:
+    """
+    A long-lived `git cat-file --batch` process for one repo.
+
+    Each lookup is a line written to its stdin and a framed response read
+    back, instead of forking `git rev-parse` / `git show` per object.
+    """
+
+    def __init__(self, repo_path: Path):
+        self._lock = threading.Lock()
+        self._proc = subprocess.Popen(
+            ["git", "cat-file", "--batch"],
+            cwd=str(repo_path),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+        self._closed = False
+
+    @property
+    def alive(self) -> bool:
+        return not self._closed and self._proc.poll() is None
+
+    def read(self, spec: str) -> Tuple[str, str, bytes] | None:
+        """Return `(sha, type, content)` for an object name, or None if missing."""
+        if "\n" in spec:
+            # Would be read as two requests and desync the protocol.
+            return None
+        with self._lock:
+            try:
+                self._proc.stdin.write(spec.encode() + b"\n")
+                self._proc.stdin.flush()
+                header = self._proc.stdout.readline()
+                if header.endswith((b" missing\n", b" ambiguous\n")):
+                    return None
+                sha, kind, size = header.split()
+                content = self._proc.stdout.read(int(size) + 1)[:-1]
+            except (OSError, ValueError) as e:
+                self._shutdown(kill=True)
+                raise GitError(f"git cat-file --batch failed reading {spec!r}") from e
+        return sha.decode(), kind.decode(), content
+
+    def close(self) -> None:
+        with self._lock:
+            self._shutdown(kill=False)
+
+    def _shutdown(self, kill: bool) -> None:
+        # Caller holds `_lock`. Reaps the process and closes both pipes, so
+        # nothing leaks and `alive` is False from here on.
+        if self._closed:
+            return
+        self._closed = True
+        if kill:
+            self._proc.kill()
+        try:
+            self._proc.stdin.close()
+        except OSError:
+            pass
+        try:
+            self._proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self._proc.kill()
+            self._proc.wait()
+        self._proc.stdout.close()
+
+
+_CAT_FILES: Dict[Path, _CatFile] = {}
+_CAT_FILES_LOCK = threading.Lock()
+
+
+def _cat_file(repo_path: Path) -> _CatFile:
+    with _CAT_FILES_LOCK:
+        cat_file = _CAT_FILES.get(repo_path)
+        if cat_file is None or not cat_file.alive:
+            if cat_file is not None:
+                cat_file.close()
+            cat_file = _CAT_FILES[repo_path] = _CatFile(repo_path)
+        return cat_file
+
+
+@atexit.register
+def _close_cat_files() -> None:
+    with _CAT_FILES_LOCK:
+        for cat_file in _CAT_FILES.values():
+            cat_file.close()
+        _CAT_FILES.clear()
+
+
+def resolve_commit_sha(block_ref: BlockRef) -> str:
+    """
+    Resolve `block_ref.ref` (branch, tag or SHA) to the full commit SHA it points at.
+    """
     repo_path = resolve_repo_path(block_ref)
-    spec = f"{block_ref.ref}:{block_ref.path}"
-    output = run_git(["show", spec], repo_path)
-    lines = output.splitlines()
+    obj = _cat_file(repo_path).read(f"{block_ref.ref}^{{commit}}")
+    if obj is None:
+        raise GitError(f"Unknown commit: {block_ref.ref}")
+    return obj[0]
+
+
+def _read_blob(repo_path: Path, spec: str) -> str:
+    obj = _cat_file(repo_path).read(spec)
+    if obj is None or obj[1] != "blob":
+        raise GitError(f"Not a file: {spec}")
+    # Decoded like `run_git` output: UTF-8 with universal newlines.
+    text = obj[2].decode(errors="replace")
+    return text.replace("\r\n", "\n").replace("\r", "\n")
+
+
+# File contents at a commit never change, so they are kept in a process-wide
+# LRU keyed by commit SHA (branches and tags are resolved first) and bounded
+# by total characters.
+_FULL_SHA_RE = re.compile(r"[0-9a-f]{40}(?:[0-9a-f]{24})?")
+_FILE_CACHE_MAX_CHARS = 32 * 1024 * 1024
+_FILE_CACHE: "OrderedDict[Tuple[str, str, str], str]" = OrderedDict()
+_FILE_CACHE_CHARS = 0
+_FILE_CACHE_LOCK = threading.Lock()
+
+
+def _commit_sha(block_ref: BlockRef) -> str:
+    if _FULL_SHA_RE.fullmatch(block_ref.ref):
+        return block_ref.ref
+    return resolve_commit_sha(block_ref)
+
+
+def _show_file(block_ref: BlockRef) -> str:
+    repo_path = resolve_repo_path(block_ref)
+    sha = _commit_sha(block_ref)
+    spec = f"{sha}:{block_ref.path}"
+
+    global _FILE_CACHE_CHARS
+    key = (block_ref.repo_name, sha, block_ref.path)
+    with _FILE_CACHE_LOCK:
+        text = _FILE_CACHE.get(key)
+        if text is not None:
+            _FILE_CACHE.move_to_end(key)
+            return text
+
+    text = _read_blob(repo_path, spec)
+    if len(text) <= _FILE_CACHE_MAX_CHARS:
+        with _FILE_CACHE_LOCK:
+            if key not in _FILE_CACHE:
+                _FILE_CACHE[key] = text
+                _FILE_CACHE_CHARS += len(text)
+            while _FILE_CACHE_CHARS > _FILE_CACHE_MAX_CHARS:
+                _, evicted = _FILE_CACHE.popitem(last=False)
+                _FILE_CACHE_CHARS -= len(evicted)
+    return text
+
+
+def _split_lines(text: str) -> List[str]:
+    # Lines end at "\n" only, as git counts them for blame -L and diffs (file
+    # text is already newline-normalized). Unlike `str.splitlines`, \f, \v
+    # and \u2028 don't start a new line.
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+def _count_lines(text: str) -> int:
+    # Same count as `len(_split_lines(text))`, without building the list.
+    return text.count("\n") + (not text.endswith("\n")) if text else 0
+
+
+def read_file_at_ref(block_ref: BlockRef) -> Tuple[List[str], int]:
+    lines = _split_lines(_show_file(block_ref))
     return lines, len(lines)
 
 
+def _line_offsets(text: str, count: int) -> List[int]:
+    """
+    Start offsets of lines 1..count+1 of `text`; line n is
+    `text[offsets[n - 1]:offsets[n] - 1]`. Only the first `count` lines are
+    scanned.
+    """
+    offsets = [0]
+    pos = 0
+    for _ in range(count):
+        pos = text.find("\n", pos) + 1 or len(text) + 1
+        offsets.append(pos)
+    return offsets
+
+
+_EXT_TO_LANG = {
+    ".py": "python",
+    ".ts": "typescript",
+    ".js": "javascript",
+    ".java": "java",
+    ".cpp": "cpp",
+    ".cc": "cpp",
+    ".cxx": "cpp",
+    ".hpp": "cpp",
+    ".c": "c",
+    ".h": "c",
+    ".go": "go",
+    ".rs": "rust",
+    ".rb": "ruby",
+    ".php": "php",
+}
+
+
 def guess_language_from_path(path: str) -> str | None:
-    suffix = Path(path).suffix.lower()
-    if suffix == ".py":
-        return "python"
-    if suffix == ".ts":
-        return "typescript"
-    if suffix == ".js":
-        return "javascript"
-    if suffix == ".java":
-        return "java"
-    if suffix in {".cpp", ".cc", ".cxx", ".hpp"}:
-        return "cpp"
-    if suffix in {".c", ".h"}:
-        return "c"
-    if suffix == ".go":
-        return "go"
-    if suffix == ".rs":
-        return "rust"
-    if suffix == ".rb":
-        return "ruby"
-    if suffix == ".php":
-        return "php"
-    return None
+    return _EXT_TO_LANG.get(Path(path).suffix.lower())
 
 
 def get_code_context(block_ref: BlockRef, context_lines: int = 10) -> CodeContext:
-    lines, total = read_file_at_ref(block_ref)
+    text = _show_file(block_ref)
+    total = _count_lines(text)
 
     if block_ref.start_line < 1 or block_ref.end_line > total:
         raise GitError(
@@ -101,8 +331,11 @@ def get_code_context(block_ref: BlockRef, context_lines: int = 10) -> CodeContex
     ctx_start = max(1, start - context_lines)
     ctx_end = min(total, end + context_lines)
 
-    code_block = "\n".join(lines[start - 1 : end])
-    surrounding_code = "\n".join(lines[ctx_start - 1 : ctx_end])
+    # Slice the blob directly rather than splitting the whole file into
+    # lines and joining the block back together.
+    offsets = _line_offsets(text, ctx_end)
+    code_block = text[offsets[start - 1] : offsets[end] - 1]
+    surrounding_code = text[offsets[ctx_start - 1] : offsets[ctx_end] - 1]
 
     language = guess_language_from_path(block_ref.path)
 
@@ -117,54 +350,49 @@ def get_code_context(block_ref: BlockRef, context_lines: int = 10) -> CodeContex
     )
 
 
+# One whole `--line-porcelain` entry. git always emits the header line,
+# then author/author-mail/author-time, and later summary and filename, then
+# the tab-prefixed source line; headers in between are skipped.
+_BLAME_ENTRY_RE = re.compile(
+    r"^([0-9a-f]{40,64}) \d+ (\d+)(?: \d+)?\n"
+    r"author (.*)\nauthor-mail (.*)\nauthor-time (.*)\n"
+    r"(?:.*\n)*?summary (.*)\n"
+    r"(?:.*\n)*?filename (.*)\n"
+    r"\t(.*)\n",
+    re.MULTILINE,
+)
+
+
 def parse_blame_porcelain(output: str, block_ref: BlockRef) -> List[BlameEntry]:
-    entries: List[BlameEntry] = []
-    current: dict | None = None
-
-    for raw_line in output.splitlines():
-        line = raw_line.rstrip("\n")
-
-        if line.startswith("\t"):
-            if current is not None:
-                code = line[1:]
-                entry = BlameEntry(
-                    block_ref=block_ref,
-                    line=current.get("final_lineno"),
-                    code=code,
-                    commit=current.get("sha"),
-                    author=current.get("author"),
-                    author_email=current.get("author_mail"),
-                    author_time=current.get("author_time"),
-                    summary=current.get("summary"),
-                    filename=current.get("filename"),
-                )
-                entries.append(entry)
-                current = None
-            continue
-
-        if current is None:
-            parts = line.split()
-            if len(parts) >= 3:
-                sha = parts[0]
-                final_lineno = int(parts[2])
-                current = {"sha": sha, "final_lineno": final_lineno}
-            continue
-
-        if " " in line:
-            key, value = line.split(" ", 1)
-            value = value.strip()
-            if key == "author":
-                current["author"] = value
-            elif key == "author-mail":
-                current["author_mail"] = value
-            elif key == "author-time":
-                current["author_time"] = value
-            elif key == "summary":
-                current["summary"] = value
-            elif key == "filename":
-                current["filename"] = value
-
-    return entries
+    return list(iter_blame_porcelain([output], block_ref))
+
+
+def iter_blame_porcelain(chunks: Iterable[str], block_ref: BlockRef) -> Iterator[BlameEntry]:
+    """
+    Parse `git blame --line-porcelain` output incrementally.
+
+    `chunks` may split the output anywhere. Each complete entry is matched
+    by a single regex rather than stepping through its ~13 lines in Python.
+    """
+    buffer = ""
+    for chunk in chunks:
+        buffer += chunk
+        end = 0
+        for match in _BLAME_ENTRY_RE.finditer(buffer):
+            sha, final_lineno, author, author_mail, author_time, summary, filename, code = match.groups()
+            yield BlameEntry(
+                block_ref=block_ref,
+                line=int(final_lineno),
+                code=code,
+                commit=sha,
+                author=author.strip(),
+                author_email=author_mail.strip(),
+                author_time=author_time.strip(),
+                summary=summary.strip(),
+                filename=filename.strip(),
+            )
+            end = match.end()
+        buffer = buffer[end:]
 
 
 def get_blame_entries(block_ref: BlockRef) -> List[BlameEntry]:
@@ -178,13 +406,75 @@ def get_blame_entries(block_ref: BlockRef) -> List[BlameEntry]:
         "--",
         block_ref.path,
     ]
-    output = run_git(args, repo_path)
-    return parse_blame_porcelain(output, block_ref)
+    # Streamed and parsed as it arrives, so the raw blame output is never
+    # held in full.
+    return list(iter_blame_porcelain(run_git_stream(args, repo_path), block_ref))
+
+
+# Blame of a line range at a commit never changes; keyed by
+# (repo, commit SHA, path, start, end). Entries are also stored under the
+# commit that last touched the file, so commits that leave the file alone
+# share them.
+_BLAME_CACHE_MAXSIZE = 256
+_BLAME_CACHE: "OrderedDict[Tuple[str, str, str, int, int], List[BlameEntry]]" = OrderedDict()
+_BLAME_CACHE_LOCK = threading.Lock()
 
 
 def get_blame_block(block_ref: BlockRef) -> BlameBlock:
-    entries = get_blame_entries(block_ref)
-    return BlameBlock(block_ref=block_ref, entries=entries)
+    sha = _commit_sha(block_ref)
+    key = (block_ref.repo_name, sha, block_ref.path, block_ref.start_line, block_ref.end_line)
+    with _BLAME_CACHE_LOCK:
+        entries = _BLAME_CACHE.get(key)
+        if entries is not None:
+            _BLAME_CACHE.move_to_end(key)
+
+    if entries is None:
+        # Blame at `sha` equals blame at the last commit that changed the
+        # file, which a cheap `git log -1` finds (empty if the path is
+        # missing, in which case blame reports the error).
+        repo_path = resolve_repo_path(block_ref)
+        touched = run_git(["log", "-1", "--format=%H", sha, "--", block_ref.path], repo_path).strip() or sha
+        touched_key = (*key[:1], touched, *key[2:])
+        with _BLAME_CACHE_LOCK:
+            entries = _BLAME_CACHE.get(touched_key)
+        if entries is None:
+            entries = get_blame_entries(block_ref.model_copy(update={"ref": touched}))
+        with _BLAME_CACHE_LOCK:
+            _BLAME_CACHE[touched_key] = entries
+            _BLAME_CACHE[key] = entries
+            while len(_BLAME_CACHE) > _BLAME_CACHE_MAXSIZE:
+                _BLAME_CACHE.popitem(last=False)
+
+    if entries and entries[0].block_ref != block_ref:
+        entries = [entry.model_copy(update={"block_ref": block_ref}) for entry in entries]
+    return BlameBlock(block_ref=block_ref, entries=list(entries))
+
+
+# Each commit is printed as NUL, then NUL-separated fields, then NUL and the
+# patch, so splitting the whole log on NUL yields 6 tokens per commit.
+_LOG_FORMAT = "--format=%x00%H%x00%an%x00%ae%x00%ad%x00%B%x00"
+_LOG_FIELDS = 6
+
+
+def _log_commits(shas: List[str], repo_path: Path, path: str | None = None) -> dict[str, CommitSummary]:
+    args = ["log", "--no-walk", _LOG_FORMAT, *shas]
+    if path is not None:
+        args += ["-p", "--", path]
+    tokens = run_git(args, repo_path).split("\x00")[1:]
+
+    summaries: dict[str, CommitSummary] = {}
+    for i in range(0, len(tokens) - _LOG_FIELDS + 1, _LOG_FIELDS):
+        full_sha, author, author_email, date, message, patch = tokens[i:i + _LOG_FIELDS]
+        summaries[full_sha] = CommitSummary(
+            sha=full_sha,
+            author=author,
+            author_email=author_email or None,
+            date=date,
+            message=message.strip(),
+            diff_hunks_for_block=[patch.strip("\n")],
+            pr_numbers=None,
+        )
+    return summaries
 
 
 def get_commit_summaries_for_block(block_ref: BlockRef, max_commits: int = 10) -> Tuple[BlameBlock | None, List[CommitSummary]]:
@@ -194,50 +484,18 @@ def get_commit_summaries_for_block(block_ref: BlockRef, max_commits: int = 10) -
 
     repo_path = resolve_repo_path(block_ref)
 
-    seen = set()
-    shas: List[str] = []
-    for entry in blame_block.entries:
-        sha = entry.commit
-        if not sha:
-            continue
-        if sha not in seen:
-            seen.add(sha)
-            shas.append(sha)
-
-    shas = shas[:max_commits]
-
-    summaries: List[CommitSummary] = []
-    for sha in shas:
-        meta_output = run_git([
-            "show",
-            "-s",
-            "--format=%H%n%an%n%ae%n%ad%n%B",
-            sha,
-        ], repo_path)
-        meta_lines = meta_output.splitlines()
-        if len(meta_lines) < 4:
-            continue
-
-        full_sha = meta_lines[0]
-        author = meta_lines[1]
-        author_email = meta_lines[2] or None
-        date = meta_lines[3]
-        message = "\n".join(meta_lines[4:]).strip()
-
-        diff_output = run_git(["show", sha, "--", block_ref.path], repo_path)
-
-        summaries.append(
-            CommitSummary(
-                sha=full_sha,
-                author=author,
-                author_email=author_email,
-                date=date,
-                message=message,
-                diff_hunks_for_block=[diff_output],
-                pr_numbers=None,
-            )
-        )
+    # Distinct commits in blame order.
+    shas = list(islice(dict.fromkeys(entry.commit for entry in blame_block.entries if entry.commit), max_commits))
+
+    # One `git log` for all commits instead of two `git show` per commit.
+    # Commits whose diff doesn't touch the path (e.g. across a rename) are
+    # pruned by the pathspec, so those are fetched again without it.
+    by_sha = _log_commits(shas, repo_path, block_ref.path)
+    missing = [sha for sha in shas if sha not in by_sha]
+    if missing:
+        by_sha.update(_log_commits(missing, repo_path))
 
+    summaries = [by_sha[sha] for sha in shas if sha in by_sha]
     return blame_block, summaries
 
 
@@ -260,11 +518,15 @@ __all__ = [
     "GitError",
     "get_repos_root",
     "resolve_repo_path",
+    "clear_cache",
     "run_git",
+    "run_git_stream",
+    "resolve_commit_sha",
     "read_file_at_ref",
     "guess_language_from_path",
     "get_code_context",
     "parse_blame_porcelain",
+    "iter_blame_porcelain",
     "get_blame_entries",
     "get_blame_block",
     "get_commit_summaries_for_block",
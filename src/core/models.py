@@ -2,10 +2,13 @@ from __future__ import annotations
 
 from typing import List, Optional, Dict, Any
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 
 
 class BlockRef(BaseModel):
+    # Immutable and hashable, so a block ref can be used directly as a cache key.
+    model_config = ConfigDict(frozen=True)
+
     repo_owner: str
     repo_name: str
     ref: str
@@ -0,0 +1,115 @@
+from __future__ import annotations
+
+import hashlib
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from config import settings
+
+
+# Expired and excess rows are swept once per this many writes (and when the
+# store opens).
+_CLEANUP_EVERY_WRITES = 256
+
+
+class ToolResultStore:
+    """
+    SQLite-backed key/value store for serialized tool results.
+
+    The agent's in-memory LRU only lives as long as one worker process. This
+    store sits behind it so every Uvicorn worker (and restarts) share results
+    for the same block at the same commit. Entries may carry a TTL; expired
+    rows are treated as missing and overwritten on the next `set`.
+
+    Keys are stored as 16-byte BLAKE2b digests rather than the (long, JSON)
+    key strings callers pass, which keeps the primary-key index small.
+
+    The store holds at most about `max_entries` rows; beyond that the least
+    recently written rows are evicted. `INSERT OR REPLACE` gives every write
+    a fresh rowid, so that is simply the lowest rowids.
+    """
+
+    def __init__(self, path: Path, max_entries: int = 50_000):
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(path), check_same_thread=False)
+        # WAL lets readers in other workers proceed while one worker writes.
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS tool_results ("
+            "key BLOB PRIMARY KEY, value TEXT NOT NULL, expires_at REAL)"
+        )
+        # Expiry index, so a sweep only visits the rows that have expired.
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS tool_results_expires_at "
+            "ON tool_results (expires_at) WHERE expires_at IS NOT NULL"
+        )
+        self._conn.commit()
+        self.max_entries = max_entries
+        self._writes = 0
+        self.cleanup()
+
+    @staticmethod
+    def _digest(key: str) -> bytes:
+        return hashlib.blake2b(key.encode(), digest_size=16).digest()
+
+    def get(self, key: str) -> str | None:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value, expires_at FROM tool_results WHERE key = ?", (self._digest(key),)
+            ).fetchone()
+        if row is None:
+            return None
+        value, expires_at = row
+        if expires_at is not None and expires_at <= time.time():
+            return None
+        return value
+
+    def set(self, key: str, value: str, ttl: float | None = None) -> None:
+        # Wall-clock expiry, since rows are shared between processes.
+        expires_at = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO tool_results (key, value, expires_at) VALUES (?, ?, ?)",
+                (self._digest(key), value, expires_at),
+            )
+            self._conn.commit()
+            self._writes += 1
+            sweep = self._writes % _CLEANUP_EVERY_WRITES == 0
+        if sweep:
+            self.cleanup()
+
+    def cleanup(self) -> int:
+        with self._lock:
+            deleted = self._conn.execute(
+                "DELETE FROM tool_results WHERE expires_at IS NOT NULL AND expires_at <= ?",
+                (time.time(),),
+            ).rowcount
+            excess = self._conn.execute("SELECT COUNT(*) FROM tool_results").fetchone()[0]
+            excess -= self.max_entries
+            if excess > 0:
+                deleted += self._conn.execute(
+                    "DELETE FROM tool_results WHERE rowid IN "
+                    "(SELECT rowid FROM tool_results ORDER BY rowid LIMIT ?)",
+                    (excess,),
+                ).rowcount
+            self._conn.commit()
+        return deleted
+
+
+_STORE: ToolResultStore | None = None
+
+
+def get_tool_result_store() -> ToolResultStore:
+    global _STORE
+    if _STORE is None:
+        _STORE = ToolResultStore(settings.cache_dir / "tool_results.sqlite3")
+    return _STORE
+
+
+__all__ = [
+    "ToolResultStore",
+    "get_tool_result_store",
+]
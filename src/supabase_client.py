@@ -1,7 +1,38 @@
-from supabase import create_client
+import httpx
+from supabase import AsyncClient, AsyncClientOptions
+
 from config import settings
 
-supabase = create_client(
-    settings.supabase_url,
-    settings.supabase_service_role_key
-)
\ No newline at end of file
+
+_CLIENT: AsyncClient | None = None
+
+
+async def get_supabase_client() -> AsyncClient:
+    # Created on first use, so workers and endpoints that never touch Supabase
+    # don't pay for it. One pooled HTTP/2 client carries every PostgREST call,
+    # so connections (and their TLS sessions) are reused across requests.
+    # Async so FastAPI runs it on the event loop: no threadpool hop per
+    # request, and no race between threads building duplicate clients.
+    global _CLIENT
+    if _CLIENT is None:
+        http_client = httpx.AsyncClient(
+            http2=True,
+            limits=httpx.Limits(
+                max_keepalive_connections=20,
+                max_connections=50,
+                keepalive_expiry=30,
+            ),
+        )
+        _CLIENT = AsyncClient(
+            settings.supabase_url,
+            settings.supabase_service_role_key,
+            options=AsyncClientOptions(httpx_client=http_client),
+        )
+    return _CLIENT
+
+
+async def close_supabase_client() -> None:
+    global _CLIENT
+    if _CLIENT is not None:
+        await _CLIENT.options.httpx_client.aclose()
+        _CLIENT = None